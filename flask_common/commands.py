@@ -11,7 +11,7 @@ import flask_script
 from werkzeug.local import LocalProxy
 
 
-__all__ = ['ContextlessCommand', 'Manager', 'Test']
+__all__ = ['ArchiveDeleted', 'ContextlessCommand', 'Manager', 'Test']
 
 
 # Hack to satisfy isinstance() check in flask_scripts.Manager.__call__ for
@@ -137,3 +137,41 @@ class Test(flask_script.Command):
         import pytest
         import sys
         sys.exit(pytest.main(args))
+
+
+class ArchiveDeleted(flask_script.Command):
+    """
+    Management command that moves deleted documents of a SoftDeleteDocument
+    class to its archive collection (see
+    flask_common.documents.archive_deleted).
+
+    Example:
+
+        manager.add_command('archive_deleted', ArchiveDeleted())
+
+        $ python manage.py archive_deleted Lead --days 90 --delay 0.5
+    """
+
+    help = 'Move deleted documents to the archive collection'
+
+    option_list = (
+        flask_script.Option('document', help='Name of the document class'),
+        flask_script.Option('--days', type=int, default=30,
+                            help='Archive documents deleted at least this many days ago'),
+        flask_script.Option('--field', default='date_updated',
+                            help='Date field to compare with'),
+        flask_script.Option('--batch-size', dest='batch_size', type=int, default=1000),
+        flask_script.Option('--delay', type=float, default=0,
+                            help='Seconds to sleep between batches'),
+    )
+
+    def run(self, document, days, field, batch_size, delay):
+        # Keep imports inlined so they're not unnecessarily imported.
+        import datetime
+        from mongoengine.base import get_document
+        from flask_common.documents import archive_deleted
+
+        count = archive_deleted(get_document(document),
+                                datetime.timedelta(days=days), field=field,
+                                batch_size=batch_size, delay=delay)
+        print('Archived %d documents' % count)
@@ -3,29 +3,137 @@ import uuid
 import sqlalchemy as db
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy import inspect
 from sqlalchemy.orm import relationship, synonym
 
-__all__ = ['MongoReference', 'MongoEmbedded', 'MongoEmbeddedList', 'Base', 'UserBase']
+from .identity_map import fetch_document, get_identity_map
+from .loader import get_reference_loader
+from .utils.id import time_ordered_uuid
+
+__all__ = ['MongoReference', 'MongoEmbedded', 'MongoEmbeddedList', 'Base',
+           'UserBase', 'fetch_mongo_references']
+
+class MongoReferenceProperty(property):
+    """
+    Descriptor of a MongoReference synonym. Remembers the name of the field
+    holding the ID and the referenced document class.
+    """
+    def __init__(self, field, ref_cls, fget, fset):
+        super(MongoReferenceProperty, self).__init__(fget, fset)
+        self.field = field
+        self.ref_cls = ref_cls
+        self.cache_attr = '_%s__cache' % field
+
+def _ref_key(val):
+    # IDs are stored as strings, see MongoReference._set
+    return str(val) if isinstance(val, ObjectId) else val
+
+def _get_reference(obj, field, ref_cls):
+    # Lazily fetches a MongoReference (recognized by the N+1 detector, see
+    # flask_common.nplusone), or gets a proxy from the reference loader (see
+    # flask_common.loader) if it's enabled.
+    if not hasattr(obj, '_%s__cache' % field):
+        pk = getattr(obj, field)
+        loader = get_reference_loader()
+        if loader is not None and pk is not None:
+            doc = loader.load(ref_cls, pk)
+        else:
+            doc = fetch_document(ref_cls, pk)
+        setattr(obj, '_%s__cache' % field, doc)
+    return getattr(obj, '_%s__cache' % field)
 
 def MongoReference(field, ref_cls):
     """
     Reference to a MongoDB table. The value is cached until an assignment is
-    made.
+    made. Documents are looked up in the identity map of the current app
+    context (see flask_common.identity_map) before querying. Use
+    fetch_mongo_references to fetch the references of multiple objects at
+    once.
     """
     def _get(obj):
-        if not hasattr(obj, '_%s__cache' % field):
-            setattr(obj, '_%s__cache' % field,
-                ref_cls.objects.get(pk=getattr(obj, field)))
-        return getattr(obj, '_%s__cache' % field)
+        return _get_reference(obj, field, ref_cls)
     def _set(obj, val):
         if hasattr(obj, '_%s__cache' % field):
-            delattr(obj, '_%s__cache')
+            delattr(obj, '_%s__cache' % field)
         if isinstance(val, ref_cls):
             val = val.pk
         if isinstance(val, ObjectId):
             val = str(val)
         setattr(obj, field, val)
-    return synonym(field, descriptor=property(_get, _set))
+    return synonym(field, descriptor=MongoReferenceProperty(field, ref_cls, _get, _set))
+
+def fetch_mongo_references(objs, names, cache_map=None):
+    """
+    Fetches the MongoDB documents referenced by the given MongoReference
+    synonyms of the given Base instances, with a single query per document
+    class, and caches them on the instances. This is the SQL-side
+    counterpart of flask_common.documents.fetch_related. Sample usage:
+
+    fetch_mongo_references(rows, ['user', 'lead'])
+
+    References that don't exist aren't cached, so accessing them raises
+    DoesNotExist as usual. A cache_map can be passed to avoid fetching the
+    same documents multiple times. It has the same form as in fetch_related
+    (and can be shared with it):
+    { DocumentClass: { id_of_fetched_obj: obj, id_of_fetched_obj2: obj2 } }.
+    """
+    if not objs:
+        return
+
+    if cache_map is None:
+        cache_map = {}
+
+    identity_map = get_identity_map()
+
+    # (MongoReference property, objs) for each synonym and SQL model
+    steps = []
+
+    # IDs to fetch by document class
+    fetch_map = {}
+
+    objs_by_type = {}
+    for obj in objs:
+        if obj is not None:
+            objs_by_type.setdefault(type(obj), []).append(obj)
+
+    for model, model_objs in objs_by_type.iteritems():
+        synonyms = inspect(model).synonyms
+        for name in names:
+            if name not in synonyms:
+                continue  # None of the objects contains this synonym
+            prop = synonyms[name].descriptor
+            if not isinstance(prop, MongoReferenceProperty):
+                raise ValueError('%s.%s is not a MongoReference' % (model.__name__, name))
+
+            steps.append((prop, model_objs))
+            ref_cls = prop.ref_cls
+            cached = cache_map.setdefault(ref_cls, {})
+            cached_keys = set(_ref_key(pk) for pk in cached)
+            for obj in model_objs:
+                pk = getattr(obj, prop.field)
+                if pk is None or hasattr(obj, prop.cache_attr) or pk in cached_keys:
+                    continue
+                doc = identity_map.get(ref_cls, pk) if identity_map is not None else None
+                if doc is not None:
+                    cached[doc.pk] = doc
+                    cached_keys.add(pk)
+                else:
+                    fetch_map.setdefault(ref_cls, set()).add(pk)
+
+    # Fetch objects and cache them
+    for ref_cls, ids in fetch_map.iteritems():
+        for doc in ref_cls.objects.filter(pk__in=list(ids)).clear_initial_query():
+            cache_map[ref_cls][doc.pk] = doc
+            if identity_map is not None:
+                identity_map.add(doc)
+
+    # Seed the per-object caches
+    for prop, model_objs in steps:
+        pk_to_obj = { _ref_key(pk): doc for pk, doc in cache_map[prop.ref_cls].iteritems() }
+        for obj in model_objs:
+            doc = pk_to_obj.get(getattr(obj, prop.field))
+            if doc is not None and not hasattr(obj, prop.cache_attr):
+                setattr(obj, prop.cache_attr, doc)
 
 def MongoEmbedded(field, emb_cls):
     """
@@ -53,8 +161,21 @@ class PGSQLModeListener(object):
         c.execute("SET TIME ZONE UTC")
         c.close()
 
+def _generate_base_id(context):
+    table = context.compiled.statement.table
+    if table.info.get('time_ordered_id'):
+        return str(time_ordered_uuid())
+    return str(uuid.uuid4())
+
 class Base(object):
-    id = db.Column(UUID, default=lambda: str(uuid.uuid4()), primary_key=True)
+    """
+    Base model with a UUID primary key and creation/update timestamps.
+
+    To generate time-ordered UUIDs (see flask_common.utils.id.time_ordered_uuid)
+    instead of random ones, which keeps inserts local in the primary key index,
+    set `__table_args__ = {'info': {'time_ordered_id': True}}` on the model.
+    """
+    id = db.Column(UUID, default=_generate_base_id, primary_key=True)
     created_at = db.Column(db.DateTime(), default=db.func.now())
     updated_at = db.Column(db.DateTime(), default=db.func.now(), onupdate=db.func.now())
 
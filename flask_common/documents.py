@@ -1,20 +1,98 @@
 import os
 import datetime
+import Queue
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from bson import BSON, ObjectId, json_util
+from pymongo.errors import BulkWriteError
 from flask import current_app
-from zbase62 import zbase62
 from mongoengine import *
-from mongoengine.queryset import OperationError
+from mongoengine.base import BaseDocument, get_document
+from mongoengine.queryset import OperationError, transform
 from mongoengine.errors import ValidationError
 
+from .identity_map import get_identity_map, invalidate_document
+from .loader import get_reference_loader, resolve_reference
+from .utils.id import IDFactory, generate_time_ordered_id
+from .utils.lists import grouper
+from .utils.objects import freeze, get_query_shape
+
 class StringIdField(StringField):
     def to_mongo(self, value):
         if not isinstance(value, basestring):
             raise ValidationError(errors={self.name: ['StringIdField only accepts string values.']})
         return super(StringIdField, self).to_mongo(value)
 
+_random_pk_factory = IDFactory(num_bytes=32)
+
+
+class CountCache(object):
+    """
+    Process-local cache of query counts with a TTL, kept per collection so
+    that writes can invalidate all the counts of a collection.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._size = 0
+        self._counts = {}
+
+    def get(self, collection_name, key):
+        entry = self._counts.get(collection_name, {}).get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
+
+    def set(self, collection_name, key, count, ttl):
+        if self._size >= self.max_size:
+            self.clear()
+        counts = self._counts.setdefault(collection_name, {})
+        if key not in counts:
+            self._size += 1
+        counts[key] = (time.time() + ttl, count)
+
+    def invalidate(self, collection_name):
+        self._size -= len(self._counts.pop(collection_name, ()))
+
+    def clear(self):
+        self._counts = {}
+        self._size = 0
+
+
+count_cache = CountCache()
+
+
+def _invalidate_caches(obj):
+    # Called after writing the given document.
+    invalidate_document(obj)
+    loader = get_reference_loader()
+    if loader is not None:
+        loader.discard(obj.__class__, obj.pk)
+    count_cache.invalidate(obj._get_collection_name())
+
+
+def _invalidate_collection_caches(doc_cls):
+    # Called after a queryset-level write, where we don't know which
+    # documents were affected.
+    identity_map = get_identity_map()
+    if identity_map is not None:
+        identity_map.discard_all(doc_cls)
+    loader = get_reference_loader()
+    if loader is not None:
+        loader.discard_all(doc_cls)
+    count_cache.invalidate(doc_cls._get_collection_name())
+
+
 class RandomPKDocument(Document):
     id = StringIdField(primary_key=True)
 
+    # Set to True in a subclass to generate time-ordered primary keys, which
+    # keeps inserts local in the _id index. The creation time can be
+    # extracted with flask_common.utils.id.id_to_datetime.
+    time_ordered_pk = False
+
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.id)
 
@@ -22,6 +100,17 @@ class RandomPKDocument(Document):
     def get_pk_prefix(cls):
         return cls._get_collection_name()[:4]
 
+    @classmethod
+    def generate_pk(cls):
+        if cls.time_ordered_pk:
+            return generate_time_ordered_id(unicode(cls.get_pk_prefix()), num_bytes=32)
+        return _random_pk_factory.get(unicode(cls.get_pk_prefix()))
+
+    @classmethod
+    def bulk_insert(cls, docs, **kwargs):
+        """Inserts the given documents in batches. See bulk_insert."""
+        return bulk_insert(cls, docs, **kwargs)
+
     def save(self, *args, **kwargs):
         old_id = self.id
 
@@ -31,7 +120,7 @@ class RandomPKDocument(Document):
         try:
 
             if not self.id:
-                self.id = u'%s_%s' % (self.get_pk_prefix(), zbase62.b2a(os.urandom(32)))
+                self.id = self.generate_pk()
 
                 # Throw an exception if another object with this id already exists.
                 kwargs['force_insert'] = True
@@ -66,6 +155,16 @@ class DocumentBase(Document):
     def _type(self):
         return unicode(self.__class__.__name__)
 
+    @classmethod
+    def bulk_insert(cls, docs, **kwargs):
+        """Inserts the given documents in batches. See bulk_insert."""
+        return bulk_insert(cls, docs, **kwargs)
+
+    @classmethod
+    def bulk_update(cls, updates, **kwargs):
+        """Updates documents in batches. See bulk_update."""
+        return bulk_update(cls, updates, **kwargs)
+
     def save(self, *args, **kwargs):
         update_date = kwargs.pop('update_date', True)
         kwargs['cascade'] = kwargs.get('cascade', False)
@@ -74,22 +173,178 @@ class DocumentBase(Document):
             if not self.date_created:
                 self.date_created = now
             self.date_updated = now
-        return super(DocumentBase, self).save(*args, **kwargs)
+        result = super(DocumentBase, self).save(*args, **kwargs)
+        _invalidate_caches(self)
+        return result
 
     def modify(self, *args, **kwargs):
         update_date = kwargs.pop('update_date', True)
         if update_date and 'set__date_updated' not in kwargs:
             kwargs['set__date_updated'] = datetime.datetime.utcnow()
-        return super(DocumentBase, self).modify(*args, **kwargs)
+        result = super(DocumentBase, self).modify(*args, **kwargs)
+        _invalidate_caches(self)
+        return result
 
     def update(self, *args, **kwargs):
         update_date = kwargs.pop('update_date', True)
         if update_date and 'set__date_updated' not in kwargs:
             kwargs['set__date_updated'] = datetime.datetime.utcnow()
         super(DocumentBase, self).update(*args, **kwargs)
+        _invalidate_caches(self)
+
+    def delete(self, *args, **kwargs):
+        super(DocumentBase, self).delete(*args, **kwargs)
+        _invalidate_caches(self)
+
+
+class IdentityMapQuerySet(QuerySet):
+    """
+    A queryset whose get(pk=...) checks the identity map of the current app
+    context before querying and fills it after querying (see
+    flask_common.identity_map). Use it in a Document's meta['queryset_class'].
+
+    Its update (and hence update_one), modify and delete discard the
+    document class' entries from the identity map and the reference loader.
+    """
+    uses_identity_map = True
+
+    def update(self, *args, **kwargs):
+        result = super(IdentityMapQuerySet, self).update(*args, **kwargs)
+        _invalidate_collection_caches(self._document)
+        return result
+
+    def modify(self, *args, **kwargs):
+        result = super(IdentityMapQuerySet, self).modify(*args, **kwargs)
+        _invalidate_collection_caches(self._document)
+        return result
+
+    def delete(self, *args, **kwargs):
+        result = super(IdentityMapQuerySet, self).delete(*args, **kwargs)
+        _invalidate_collection_caches(self._document)
+        return result
+
+    def get(self, *q_objs, **query):
+        identity_map = get_identity_map()
+        pk = self._get_identity_map_pk(q_objs, query) if identity_map is not None else None
+        if pk is None:
+            return super(IdentityMapQuerySet, self).get(*q_objs, **query)
+
+        return identity_map.get_or_fetch(self._document, pk,
+            lambda: super(IdentityMapQuerySet, self).get(*q_objs, **query))
+
+    def _get_identity_map_pk(self, q_objs, query):
+        # only plain lookups of whole documents by their pk can be served
+        # from the identity map (and not e.g. raw SON or scalar results)
+        if q_objs or len(query) != 1 or self._none or self._loaded_fields or not self._query_obj.empty:
+            return None
+        if self._as_pymongo or getattr(self, '_as_son', False) or self._scalar:
+            return None
+        pk_keys = ('pk', self._document._meta['id_field'])
+        return next((val for key, val in query.items() if key in pk_keys), None)
+
+
+class SoftDeleteQuerySet(QuerySet):
+    """
+    Queryset of SoftDeleteDocuments that can (un)delete all the matching
+    documents at once.
+    """
+
+    def soft_delete(self):
+        """
+        Marks all the matching documents as deleted with a single update and
+        returns the number of affected documents.
+        """
+        return self._set_is_deleted(True)
 
+    def restore(self):
+        """
+        Marks all the matching deleted documents as not deleted with a single
+        update and returns the number of affected documents. Use it on
+        all_objects since objects doesn't match deleted documents.
+        """
+        return self._set_is_deleted(False)
+
+    def archived(self):
+        """
+        Returns a clone of this queryset that reads from the archive
+        collection (see archive_deleted) instead. Use it on all_objects since
+        all archived documents are deleted.
+        """
+        queryset = self.clone()
+        queryset._collection_obj = get_archive_collection(self._document)
+        # don't reuse a cursor of the original collection
+        queryset._cursor_obj = None
+        return queryset
 
-class NotDeletedQuerySet(QuerySet):
+    def iter_with_archive(self):
+        """
+        Iterates over the matching documents in the collection, followed by
+        the matching documents in the archive collection.
+        """
+        for doc in self:
+            yield doc
+        for doc in self.archived():
+            yield doc
+
+    def cached_count(self, ttl=60, with_limit_and_skip=False):
+        """
+        Like count(), but caches the count of the query for ttl seconds in
+        this process. Writes through DocumentBase/SoftDeleteDocument (and the
+        bulk helpers in this module) invalidate the cached counts of the
+        collection, other writes are only picked up when the count expires.
+        """
+        query = self.all()._query
+        key = freeze(query)
+        if with_limit_and_skip:
+            key = (key, self._limit, self._skip)
+
+        collection_name = self._document._get_collection_name()
+        count = count_cache.get(collection_name, key)
+        if count is None:
+            count = self.count(with_limit_and_skip=with_limit_and_skip)
+            count_cache.set(collection_name, key, count, ttl)
+        return count
+
+    def estimated_count(self, sample_size=1000):
+        """
+        Returns an estimate of count() without counting all the matching
+        documents, e.g. to show "about N results" for large collections.
+
+        The number of documents in the collection comes from the collection
+        metadata, and the fraction of them that match the query is estimated
+        from a random sample of sample_size documents. This works well for
+        unfiltered queries and queries that match a good part of the
+        collection, but not for very selective queries. Small collections are
+        counted exactly. Sampling uses $sample, which requires MongoDB 3.2.
+        """
+        collection = self._collection
+        total = collection.count()
+        query = self.all()._query
+        if not query:
+            return total
+        if total <= sample_size:
+            return self.count()
+
+        pipeline = [
+            { '$sample': { 'size': sample_size } },
+            { '$match': query },
+            { '$group': { '_id': None, 'count': { '$sum': 1 } } },
+        ]
+        result = list(collection.aggregate(pipeline, cursor={}))
+        matched = result[0]['count'] if result else 0
+        return int(round(total * matched / float(sample_size)))
+
+    def _set_is_deleted(self, is_deleted):
+        kwargs = {'set__is_deleted': is_deleted}
+        if issubclass(self._document, DocumentBase):
+            kwargs['set__date_updated'] = datetime.datetime.utcnow()
+
+        count = self.filter(is_deleted=not is_deleted).update(**kwargs)
+        _invalidate_collection_caches(self._document)
+        return count
+
+
+class NotDeletedQuerySet(SoftDeleteQuerySet, IdentityMapQuerySet):
     def __call__(self, q_obj=None, class_check=True, slave_okay=False, read_preference=None, **query):
         # we don't use __ne=True here, because $ne isn't a selective query and doesn't utilize an index in the most efficient manner (http://docs.mongodb.org/manual/faq/indexes/#using-ne-and-nin-in-a-query-is-slow-why)
         extra_q_obj = Q(is_deleted=False)
@@ -102,18 +357,55 @@ class NotDeletedQuerySet(QuerySet):
             self = self.all()
         return super(NotDeletedQuerySet, self).count(*args, **kwargs)
 
+NOT_DELETED_FILTER = {'is_deleted': False}
+
+
+def _not_deleted_index_spec(spec):
+    # Turns an index spec with 'exclude_deleted': True into a partial index
+    # spec that only covers documents that aren't deleted.
+    if not spec.get('exclude_deleted'):
+        return spec
+    spec = dict(spec)
+    del spec['exclude_deleted']
+    partial_filter = dict(spec.get('partialFilterExpression') or {})
+    partial_filter.update(NOT_DELETED_FILTER)
+    spec['partialFilterExpression'] = partial_filter
+    return spec
+
+
 class SoftDeleteDocument(Document):
+    """
+    Document which is marked as deleted instead of being removed.
+
+    Indexes in meta['indexes'] can be declared with 'exclude_deleted': True,
+    e.g. {'fields': ['email'], 'unique': True, 'exclude_deleted': True}, to
+    create them as partial indexes that only cover documents that aren't
+    deleted (requires MongoDB 3.2). They're smaller and unique constraints
+    don't apply to deleted documents, but they're only used for queries that
+    filter on is_deleted=False (like those of objects, unlike all_objects).
+    See partial_index_report for how much existing indexes would shrink.
+    """
     is_deleted = BooleanField(default=False, required=True)
 
+    @classmethod
+    def ensure_indexes(cls, *args, **kwargs):
+        cls._meta['index_specs'] = [
+            _not_deleted_index_spec(spec) for spec in cls._meta.get('index_specs') or []
+        ]
+        return super(SoftDeleteDocument, cls).ensure_indexes(*args, **kwargs)
+
     def modify(self, **kwargs):
         if 'set__is_deleted' in kwargs and kwargs['set__is_deleted'] is None:
             raise ValidationError('is_deleted cannot be set to None')
-        return super(SoftDeleteDocument, self).modify(**kwargs)
+        result = super(SoftDeleteDocument, self).modify(**kwargs)
+        _invalidate_caches(self)
+        return result
 
     def update(self, **kwargs):
         if 'set__is_deleted' in kwargs and kwargs['set__is_deleted'] is None:
             raise ValidationError('is_deleted cannot be set to None')
         super(SoftDeleteDocument, self).update(**kwargs)
+        _invalidate_caches(self)
 
     def delete(self, **kwargs):
         # delete only if already saved
@@ -124,7 +416,7 @@ class SoftDeleteDocument(Document):
     @queryset_manager
     def all_objects(doc_cls, queryset):
         if not hasattr(doc_cls, '_all_objs_queryset'):
-            doc_cls._all_objs_queryset = QuerySet(doc_cls, doc_cls._get_collection())
+            doc_cls._all_objs_queryset = SoftDeleteQuerySet(doc_cls, doc_cls._get_collection())
         return doc_cls._all_objs_queryset
 
     meta = {
@@ -133,137 +425,654 @@ class SoftDeleteDocument(Document):
     }
 
 
-def fetch_related(objs, field_dict, cache_map=None):
+def _is_duplicate_id_error(doc_cls, error):
+    if error.get('code') != 11000:
+        return False
+    # As in RandomPKDocument.save, match the start of the message so that
+    # the duplicate value (which is included in the message) can't fake it.
+    ns = '%s.%s' % (doc_cls._get_db().name, doc_cls._get_collection_name())
+    errmsg = error.get('errmsg', '')
+    return (errmsg.startswith('E11000 duplicate key error index: %s.$_id_ ' % ns) or
+            errmsg.startswith('E11000 duplicate key error collection: %s index: _id_ ' % ns))
+
+
+def bulk_insert(doc_cls, docs, batch_size=1000, validate=True,
+                update_date=True):
     """
-    Recursively fetches related objects for the given document instances.
-    Sample usage:
+    Inserts the given new documents of the given class using unordered bulk
+    inserts of up to batch_size documents each, instead of one round trip
+    per document.
+
+    Like DocumentBase.save, date_created/date_updated are stamped unless
+    update_date is False. RandomPKDocuments without an ID get a new one, and
+    only documents whose generated ID collides with an existing one get a new
+    ID and are retried. Note that documents are not saved via save(), so
+    there are no cascades and no signals.
+
+    Returns a tuple of a list of the inserted documents (the given instances,
+    marked as saved) and a dict mapping the index of each document that
+    couldn't be inserted to the ValidationError or OperationError why.
+    """
+    docs = list(docs)
+    collection = doc_cls._get_collection()
+    random_pk = issubclass(doc_cls, RandomPKDocument)
+    stamp_dates = update_date and issubclass(doc_cls, DocumentBase)
+    now = datetime.datetime.utcnow()
+
+    inserted = {}
+    errors = {}
+
+    # list of (index, son, whether we generated the ID) to insert
+    pending = []
+    for index, doc in enumerate(docs):
+        if stamp_dates:
+            if not doc.date_created:
+                doc.date_created = now
+            doc.date_updated = now
+
+        generated = random_pk and not doc.pk
+        if generated:
+            doc.pk = doc_cls.generate_pk()
+
+        if validate:
+            try:
+                doc.validate()
+            except ValidationError, err:
+                if generated:
+                    doc.pk = None
+                errors[index] = err
+                continue
+
+        son = doc.to_mongo()
+        if '_id' not in son:
+            son['_id'] = ObjectId()
+        pending.append((index, son, generated))
+
+    while pending:
+        retry = []
+        for batch in grouper(batch_size, pending):
+            bulk = collection.initialize_unordered_bulk_op()
+            for index, son, generated in batch:
+                bulk.insert(son)
+
+            try:
+                bulk.execute()
+                write_errors = {}
+            except BulkWriteError, err:
+                if not err.details.get('writeErrors'):
+                    raise OperationError(unicode(err))
+                write_errors = dict((error['index'], error) for error in err.details['writeErrors'])
+
+            for batch_index, (index, son, generated) in enumerate(batch):
+                error = write_errors.get(batch_index)
+                if error is None:
+                    # mark the document as saved, like Document.save does
+                    doc = docs[index]
+                    doc.pk = son['_id']
+                    doc._created = False
+                    doc._clear_changed_fields()
+                    inserted[index] = doc
+                elif generated and _is_duplicate_id_error(doc_cls, error):
+                    son['_id'] = doc_cls.generate_pk()
+                    retry.append((index, son, generated))
+                else:
+                    if generated:
+                        docs[index].pk = None
+                    errors[index] = OperationError(error.get('errmsg', ''))
+        pending = retry
+
+    if inserted:
+        # the IDs may have been cached as missing
+        loader = get_reference_loader()
+        if loader is not None:
+            for doc in inserted.itervalues():
+                loader.discard(doc_cls, doc.pk)
+        count_cache.invalidate(doc_cls._get_collection_name())
+
+    return [inserted[index] for index in sorted(inserted)], errors
+
+
+def bulk_update(doc_cls, updates, batch_size=1000, update_date=True):
+    """
+    Updates documents of the given class with per-document values using
+    unordered bulk writes of up to batch_size updates each, instead of one
+    round trip per document.
+
+    updates is an iterable of (document or pk, kwargs) pairs, where kwargs
+    use the same syntax as Document.update, e.g.
+
+        bulk_update(Lead, [
+            (lead, {'set__name': 'Acme', 'inc__num_calls': 1}),
+            (other_lead_id, {'set__name': 'Other'}),
+        ])
+
+    Like DocumentBase.modify/update, date_updated is set unless update_date
+    is False (globally or in a pair's kwargs), and like SoftDeleteDocument,
+    is_deleted can't be set to None. All updates are checked before anything
+    is sent.
+
+    Returns a list with a dict of the number of matched and modified
+    documents for each batch. The number of modified documents is None if
+    the server doesn't report it.
+    """
+    id_field = doc_cls._fields[doc_cls._meta['id_field']]
+    is_soft_delete = issubclass(doc_cls, SoftDeleteDocument)
+    is_document_base = issubclass(doc_cls, DocumentBase)
+    now = datetime.datetime.utcnow()
+
+    operations = []
+    for doc_or_pk, kwargs in updates:
+        kwargs = dict(kwargs)
+        pk = doc_or_pk.pk if isinstance(doc_or_pk, BaseDocument) else doc_or_pk
+
+        if is_soft_delete and any(key in kwargs and kwargs[key] is None
+                                  for key in ('set__is_deleted', 'is_deleted')):
+            raise ValidationError('is_deleted cannot be set to None')
 
-    fetch_related(objs, {
-        'user': True,
-        'lead': {
-            'created_by': True,
-            'updated_by': True,
-        },
-        'contact': ['id'],
-    })
+        if kwargs.pop('update_date', update_date) and is_document_base and \
+                'set__date_updated' not in kwargs:
+            kwargs['set__date_updated'] = now
 
-    In this sample, users and leads for all objs will be fetched and attached.
-    Then, lead.created_by and lead.updated_by users are fetched in one query
-    and attached. Finally, a contact will be pulled in, only fetching the ID
-    from the database.
+        # the caches are keyed by the Python value of the pk
+        operations.append((id_field.to_python(pk),
+                           id_field.prepare_query_value(None, pk),
+                           transform.update(doc_cls, **kwargs)))
 
-    Note that the function doesn't merge queries for the same document class
-    across multiple (recursive) function calls, but it never fetches the same
-    related object twice.
+    collection = doc_cls._get_collection()
+    identity_map = get_identity_map()
+    loader = get_reference_loader()
 
-    Be *very* cautious when pulling in only specific fields for a related
-    object. Accessing fields that haven't been pulled will falsely show None
-    even if a value for that field exists in the database.
+    results = []
+    for batch in grouper(batch_size, operations):
+        bulk = collection.initialize_unordered_bulk_op()
+        for pk, mongo_pk, mongo_update in batch:
+            bulk.find({'_id': mongo_pk}).update_one(mongo_update)
 
-    Given how fragile partially pulled objects are, we don't cache them in the
-    cache map and hence the same related object may be fetched more than once.
+        try:
+            result = bulk.execute()
+        except BulkWriteError, err:
+            raise OperationError(u'Bulk update failed (%s)' % err.details)
 
-    If you need to call fetch_related multiple times, it's worth passing a
-    cache_map (initially it can be an empty dictionary). It will be extended
-    during each call to include all the objects fetched up until the current
-    call. This way we ensure that the same objects aren't fetched more than
-    once across multiple fetch_related calls. Cache map has a form of:
-    { DocumentClass: { id_of_fetched_obj: obj, id_of_fetched_obj2: obj2 } }.
+        for pk, mongo_pk, mongo_update in batch:
+            if identity_map is not None:
+                identity_map.discard(doc_cls, pk)
+            if loader is not None:
+                loader.discard(doc_cls, pk)
+
+        count_cache.invalidate(doc_cls._get_collection_name())
+
+        results.append({
+            'matched': result.get('nMatched'),
+            'modified': result.get('nModified'),
+        })
+
+    return results
+
+
+def get_archive_collection(doc_cls):
     """
+    Returns the collection that archive_deleted moves deleted documents of
+    the given class to.
+    """
+    return doc_cls._get_db()[doc_cls._get_collection_name() + '_archive']
 
-    if not objs:
-        return
 
-    # Cache map holds a map of pks to objs for objects we fetched, over all
-    # iterations / from previous calls, by document class (doesn't include
-    # partially fetched objects)
-    if cache_map == None:
-        cache_map = {}
-
-    # Cache map for partial fetches (i.e. ones where only specific fields
-    # were requested). is only temporary since we don't want to cache partial
-    # data through subsequent calls of this function
-    partial_cache_map = {}
-
-    # Helper mapping: field_name -> (
-    #   field instance,
-    #   name of the field in the db,
-    #   document class,
-    #   fields to fetch (or None if the whole related obj should be fetched)
-    # )
-    field_info = {}
-
-    # IDs to fetch and their fetch options, by document class
-    fetch_map = {}
-
-    def id_from_value(field, val):
-        if field.dbref:
-            return val.id
-        else:
-            return val
+def archive_deleted(doc_cls, older_than, field='date_updated',
+                    batch_size=1000, delay=0):
+    """
+    Moves deleted documents of the given SoftDeleteDocument class whose
+    `field` (date_updated by default, which is stamped when DocumentBases are
+    deleted) is older than the given datetime or timedelta (from now) to the
+    archive collection (`<collection>_archive`), so that they don't take up
+    space in the indexes and working set of the collection anymore.
 
-    def get_instance_for_each_type(objs):
-        instances = []
-        types = []
-        for obj in objs:
-            if type(obj) not in types:
-                instances.append(obj)
-                types.append(type(obj))
-        return instances
-
-    def setattr_unchanged(obj, key, val):
-        """
-        Sets an attribute on the given document object without changing the
-        _changed_fields set. This is because we don't actually modify the
-        related objects.
-        """
-        changed = key in obj._changed_fields
-        setattr(obj, key, val)
-        if not changed and key in obj._changed_fields:
-            obj._changed_fields.remove(key)
-
-    # Populate the field_info
-    instances = get_instance_for_each_type(objs)
-    for field_name, sub_field_dict in field_dict.iteritems():
-
-        instance = [instance for instance in instances if instance and field_name in instance.__class__._fields]
-        if not instance:
-            continue  # None of the objects contains this field
-
-        instance = instance[0]
-        field = instance.__class__._fields[field_name]
-        db_field = instance._db_field_map.get(field_name, field_name)
-        if isinstance(field, ReferenceField): # includes SafeReferenceListField
-            document_class = field.document_type
-        elif isinstance(field, SafeReferenceListField):
-            document_class = field.field.document_type
-        else:
-            raise NotImplementedError('%s class not supported for fetch_related' % field.__class__.__name__)
-        fields_to_fetch = sub_field_dict if isinstance(sub_field_dict, (list, tuple)) else None
-        field_info[field_name] = (field, db_field, document_class, fields_to_fetch)
+    Documents are moved in batches of batch_size, sleeping `delay` seconds
+    after each batch to throttle the load on the database. Each batch is
+    copied to the archive before it's removed from the collection, so the
+    archiving can be interrupted and run again at any time.
+
+    Archived documents can be read with all_objects.archived() or
+    all_objects.iter_with_archive().
 
-    # Determine what IDs we want to fetch
-    for field_name, sub_field_dict in field_dict.iteritems():
-        field, db_field, document_class, fields_to_fetch = field_info.get(field_name) or (None, None, None, None)
-        if not field:
+    Returns the number of archived documents.
+    """
+    if isinstance(older_than, datetime.timedelta):
+        older_than = datetime.datetime.utcnow() - older_than
+
+    collection = doc_cls._get_collection()
+    archive_collection = get_archive_collection(doc_cls)
+    query = {
+        'is_deleted': True,
+        doc_cls._fields[field].db_field: {'$lt': older_than},
+    }
+
+    count = 0
+    while True:
+        docs = list(collection.find(query).limit(batch_size))
+        if not docs:
+            break
+
+        ids = [doc['_id'] for doc in docs]
+
+        bulk = archive_collection.initialize_unordered_bulk_op()
+        for doc in docs:
+            bulk.find({'_id': doc['_id']}).upsert().replace_one(doc)
+        bulk.execute()
+
+        # Only remove documents that are still deleted.
+        result = collection.remove({'_id': {'$in': ids}, 'is_deleted': True})
+        if result['n'] != len(ids):
+            # Some documents were restored in the meantime, so they shouldn't
+            # be in the archive.
+            restored = [doc['_id'] for doc in collection.find({'_id': {'$in': ids}}, {'_id': 1})]
+            archive_collection.remove({'_id': {'$in': restored}})
+        count += result['n']
+        count_cache.invalidate(doc_cls._get_collection_name())
+
+        if len(docs) < batch_size:
+            break
+        if delay:
+            time.sleep(delay)
+
+    return count
+
+
+def partial_index_report(doc_cls):
+    """
+    Reports how much the existing indexes of the given SoftDeleteDocument
+    class would shrink if they were partial indexes that exclude deleted
+    documents (see SoftDeleteDocument).
+
+    Returns a list of dicts with the name, key and size of each index (in
+    bytes) and its estimated size and savings as a partial index, assuming
+    deleted documents take up as much of the index as the others. The _id
+    index and indexes which are partial already are skipped. Sorted by
+    savings, largest first.
+    """
+    collection = doc_cls._get_collection()
+    stats = doc_cls._get_db().command('collstats', collection.name)
+    total = stats.get('count') or 0
+    if not total:
+        return []
+    not_deleted_fraction = collection.find(NOT_DELETED_FILTER).count() / float(total)
+
+    report = []
+    for name, info in collection.index_information().iteritems():
+        if name == '_id_' or 'partialFilterExpression' in info:
             continue
+        size = stats.get('indexSizes', {}).get(name, 0)
+        estimated_size = int(size * not_deleted_fraction)
+        report.append({
+            'name': name,
+            'key': info['key'],
+            'size': size,
+            'estimated_size': estimated_size,
+            'savings': size - estimated_size,
+        })
+
+    return sorted(report, key=lambda item: item['savings'], reverse=True)
+
 
-        # we need to use _db_data for safe references because touching their pks triggers a query
-        if isinstance(field, SafeReferenceField):
-            ids = { id_from_value(field, obj._db_data.get(db_field, None)) for obj in objs if field_name not in obj._internal_data and obj._db_data.get(db_field, None) }
-        elif isinstance(field, SafeReferenceListField):
-            ids = [ obj._db_data.get(db_field, []) for obj in objs if field_name not in obj._internal_data ]
-            ids = { id_from_value(field.field, item) for sublist in ids for item in sublist } # flatten the list of lists
+def _id_from_value(field, val):
+    if field.dbref:
+        return val.id
+    else:
+        return val
+
+
+def _setattr_unchanged(obj, key, val):
+    """
+    Sets an attribute on the given document object without changing the
+    _changed_fields set. This is because we don't actually modify the
+    related objects.
+    """
+    changed = key in obj._changed_fields
+    setattr(obj, key, val)
+    if not changed and key in obj._changed_fields:
+        obj._changed_fields.remove(key)
+
+
+class _RelatedField(object):
+    """
+    A field holding reference(s) to other documents, possibly nested in
+    embedded documents. Knows how to collect the IDs of the referenced
+    documents and how to attach the fetched documents.
+    """
+
+    def __init__(self, path, field_name, db_field, field):
+        # names of the (embedded document) fields leading to the field
+        self.path = path
+
+        self.field_name = field_name
+        self.db_field = db_field
+        self.field = field
+
+        if isinstance(field, SafeReferenceListField):
+            self.kind = 'safe_list'
+            self.item_field = field.field
+        elif isinstance(field, SafeReferenceField):
+            self.kind = 'safe'
+            self.item_field = field
         elif isinstance(field, ReferenceField):
-            ids = { getattr(obj, field_name).pk for obj in objs if getattr(obj, field_name, None) and getattr(getattr(obj, field_name), '_lazy', False) }
+            self.kind = 'reference'
+            self.item_field = field
+        elif isinstance(field, GenericReferenceField):
+            self.kind = 'generic'
+            self.item_field = field
+        elif isinstance(field, ListField) and isinstance(field.field, (ReferenceField, GenericReferenceField)):
+            self.kind = 'list'
+            self.item_field = field.field
+        else:
+            raise NotImplementedError('%s class not supported for fetch_related' % field.__class__.__name__)
+
+    def get_containers(self, objs):
+        """
+        Returns the (embedded) documents holding the field for the given
+        documents.
+        """
+        for name in self.path:
+            containers = []
+            for obj in objs:
+                val = getattr(obj, name, None)
+                if isinstance(val, (list, tuple)):
+                    containers.extend(val)
+                elif val is not None:
+                    containers.append(val)
+            objs = containers
+        return objs
+
+    def _get_ref(self, val):
+        """
+        Returns a (document class, id) tuple for a reference as it's stored
+        in the database.
+        """
+        if isinstance(self.item_field, GenericReferenceField):
+            return get_document(val['_cls']), val['_ref'].id
+        else:
+            return self.item_field.document_type, _id_from_value(self.item_field, val)
+
+    def get_ids(self, objs):
+        """
+        Returns a { document class: set of IDs } dict of related objects
+        that still need to be fetched for the given (container) objects.
+        """
+        name = self.field_name
+        if self.kind == 'reference':
+            refs = [ (self.field.document_type, getattr(obj, name).pk) for obj in objs if getattr(obj, name, None) and getattr(getattr(obj, name), '_lazy', False) ]
+
+        # we need to use _db_data for other fields because touching their pks triggers a query
+        elif self.kind in ('safe', 'generic'):
+            refs = [ self._get_ref(obj._db_data.get(self.db_field, None)) for obj in objs if name not in obj._internal_data and obj._db_data.get(self.db_field, None) ]
+        else:
+            refs = [ obj._db_data.get(self.db_field, None) or [] for obj in objs if name not in obj._internal_data ]
+            refs = [ self._get_ref(item) for sublist in refs for item in sublist ] # flatten the list of lists
+
+        ids = {}
+        for document_class, pk in refs:
+            ids.setdefault(document_class, set()).add(pk)
+        return ids
+
+    def assign(self, objs, lookup):
+        """
+        Attaches the fetched related objects to the given (container) objects
+        and returns a tuple of a list of all the (non-lazy) related objects
+        the field points at and the number of broken references (i.e. ones
+        to documents that don't exist). `lookup(document_class, pk)` returns
+        a fetched object or None.
+        """
+        name = self.field_name
+        related = []
+        broken = 0
+        for obj in objs:
+            if self.kind == 'reference':
+                val = getattr(obj, name, None)
+                if val and getattr(val, '_lazy', False):
+                    rel_obj = lookup(self.field.document_type, val.pk)
+                    if rel_obj:
+                        _setattr_unchanged(obj, name, rel_obj)
+                        val = rel_obj
+                    else:
+                        broken += 1
+                if val and not getattr(val, '_lazy', False):
+                    related.append(val)
+                continue
+
+            if name not in obj._internal_data:
+                val = obj._db_data.get(self.db_field, None)
+                if self.kind == 'safe':
+                    if val:
+                        rel_obj = lookup(*self._get_ref(val))
+                        broken += rel_obj is None
+                        _setattr_unchanged(obj, name, rel_obj)
+                elif self.kind == 'generic':
+                    rel_obj = lookup(*self._get_ref(val)) if val else None
+                    if rel_obj:
+                        _setattr_unchanged(obj, name, rel_obj)
+                    elif val:
+                        broken += 1
+                else:
+                    value = [ lookup(*self._get_ref(item)) for item in val or [] ]
+                    broken += value.count(None)
+                    if self.kind == 'safe_list':
+                        _setattr_unchanged(obj, name, filter(None, value))
+
+                    # plain lists of references are only assigned when all
+                    # the references could be fetched
+                    elif None not in value:
+                        _setattr_unchanged(obj, name, value)
+
+            if name in obj._internal_data:
+                val = getattr(obj, name)
+                if self.kind in ('safe_list', 'list'):
+                    related.extend(val or [])
+                else:
+                    related.append(val)
+
+        return [ doc for doc in related if isinstance(doc, BaseDocument) ], broken
+
+
+def _get_related_field(doc_cls, field_name):
+    """
+    Returns a _RelatedField for the given field of the document class, or
+    None if the document class doesn't contain the field. The field name can
+    be a dotted path through embedded documents, e.g. 'addresses.owner'.
+    """
+    path = field_name.split('.')
+    field_name = path[-1]
+    for name in path[:-1]:
+        field = doc_cls._fields.get(name)
+        if field is None:
+            return None
+
+        # includes EmbeddedDocumentListField
+        if isinstance(field, ListField):
+            field = field.field
+        if not isinstance(field, EmbeddedDocumentField):
+            raise NotImplementedError('%s class not supported for fetch_related paths' % field.__class__.__name__)
+        doc_cls = field.document_type
+
+    field = doc_cls._fields.get(field_name)
+    if field is None:
+        return None
 
-        # remove ids of objects that are already in the cache map
+    db_field = doc_cls._db_field_map.get(field_name, field_name)
+    return _RelatedField(path[:-1], field_name, db_field, field)
+
+
+class _FetchNode(object):
+    """A single field to fetch in a FetchPlan."""
+
+    def __init__(self, field_name, sub_field_dict, parent):
+        self.field_name = field_name
+
+        # node whose related objects this field is fetched for (None for the
+        # fields of the objects passed to fetch_related)
+        self.parent = parent
+
+        # dotted path of the field from the objects passed to fetch_related
+        self.path = field_name if parent is None else '%s.%s' % (parent.path, field_name)
+
+        # fields to fetch (or None if the whole related obj should be fetched)
+        self.fields_to_fetch = sub_field_dict if isinstance(sub_field_dict, (list, tuple)) else None
+
+        self.sub_field_dict = sub_field_dict if isinstance(sub_field_dict, dict) else {}
+
+
+class FetchPlan(object):
+    """
+    A fetch_related field_dict compiled into a breadth-first, level-by-level
+    plan. Related objects of all the fields at the same depth are fetched
+    together, with one query per document class, so the number of queries
+    depends on the depth of the field_dict rather than on the number of fields
+    it names.
+
+    A plan doesn't depend on the objects it's executed for, so it can be
+    reused for repeated calls with the same field_dict. Use
+    compile_fetch_plan to get a (cached) plan for a field_dict.
+
+    For very large sets of related objects, pass chunk_size to split the IDs
+    of each document class into multiple queries of at most chunk_size IDs,
+    and max_workers to run up to that many of these queries concurrently in
+    a thread pool. The results are merged into the same cache_map.
+    """
+
+    def __init__(self, field_dict, chunk_size=None, max_workers=1):
+        self.field_dict = field_dict
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+
+        # List of levels, each of them being a list of _FetchNode instances
+        self.levels = []
+
+        # _RelatedField instances by (document class, field name)
+        self._related_fields = {}
+
+        nodes = [_FetchNode(field_name, sub_field_dict, None)
+                 for field_name, sub_field_dict in field_dict.iteritems()]
+        while nodes:
+            self.levels.append(nodes)
+            nodes = [_FetchNode(field_name, sub_field_dict, node)
+                     for node in nodes
+                     for field_name, sub_field_dict in node.sub_field_dict.iteritems()]
+
+    def __repr__(self):
+        return '<FetchPlan: %r>' % self.field_dict
+
+    def get_related_field(self, doc_cls, field_name):
+        key = (doc_cls, field_name)
+        if key not in self._related_fields:
+            self._related_fields[key] = _get_related_field(doc_cls, field_name)
+        return self._related_fields[key]
+
+    def fetch(self, objs, cache_map=None):
+        """
+        Fetches the related objects for the given document instances and
+        returns the numbers of broken references by field path. See
+        fetch_related for details.
+        """
+        if cache_map == None:
+            cache_map = {}
+
+        # Objects loaded earlier in the current app context are used instead
+        # of fetching them again (see flask_common.identity_map)
+        identity_map = get_identity_map()
+
+        # Objects whose fields a node is fetched for, by parent node. Proxies
+        # of a ReferenceLoader are replaced by their documents, which are
+        # fetched with one query per document class.
+        node_objs = { None: [ resolve_reference(obj) for obj in objs ] }
+        broken = {}
+        for level in self.levels:
+            self._fetch_level(level, node_objs, cache_map, identity_map, broken)
+        return broken
+
+    def _fetch_level(self, level, node_objs, cache_map, identity_map, broken):
+        # Cache map for partial fetches (i.e. ones where only specific fields
+        # were requested). Is only temporary since we don't want to cache
+        # partial data through subsequent levels or calls
+        partial_cache_map = {}
+
+        # IDs to fetch and their fetch options, by document class
+        fetch_map = {}
+
+        # (node, related field, container objs) for each field and document type on this level
+        steps = []
+
+        # Determine what IDs we want to fetch
+        for node in level:
+            objs_by_type = {}
+            seen = set()
+            for obj in node_objs.get(node.parent) or []:
+                if obj is not None and id(obj) not in seen:
+                    seen.add(id(obj))
+                    objs_by_type.setdefault(type(obj), []).append(obj)
+
+            for doc_type, objs in objs_by_type.iteritems():
+                related_field = self.get_related_field(doc_type, node.field_name)
+                if not related_field:
+                    continue  # None of the objects contains this field
+
+                containers = related_field.get_containers(objs)
+                steps.append((node, related_field, containers))
+
+                for document_class, ids in related_field.get_ids(containers).iteritems():
+                    self._add_to_fetch_map(fetch_map, document_class, ids,
+                                           node.fields_to_fetch, cache_map,
+                                           partial_cache_map, identity_map)
+
+        # Fetch objects and cache them - either in the persistent cache map
+        # with full objects, or in the ephemeral partial cache
+        for document_class, fields_to_fetch, update_dict in self._fetch_documents(fetch_map):
+            if fields_to_fetch is None:
+                cache_map[document_class].update(update_dict)
+                if identity_map is not None:
+                    for obj in update_dict.itervalues():
+                        identity_map.add(obj)
+            else:
+                partial_cache_map[document_class].update(update_dict)
+
+        # Remember the IDs of documents that don't exist (tombstones), so
+        # that they aren't fetched again with the same cache map
+        for document_class, fetch_opts in fetch_map.iteritems():
+            cached = cache_map[document_class]
+            partial = partial_cache_map[document_class]
+            for pk in fetch_opts['ids']:
+                if pk not in cached and pk not in partial:
+                    cached[pk] = None
+
+        # partially fetched objects take precedence, like in the fetch map
+        def lookup(document_class, pk):
+            obj = partial_cache_map.get(document_class, {}).get(pk)
+            if obj is None:
+                obj = cache_map.get(document_class, {}).get(pk)
+            return obj
+
+        # Assign objects and collect the related objects for the next level
+        for node, related_field, containers in steps:
+            related, broken_count = related_field.assign(containers, lookup)
+            if broken_count:
+                broken[node.path] = broken.get(node.path, 0) + broken_count
+            if node.sub_field_dict:
+                node_objs.setdefault(node, []).extend(related)
+
+    def _add_to_fetch_map(self, fetch_map, document_class, ids, fields_to_fetch,
+                          cache_map, partial_cache_map, identity_map):
+        # remove ids of objects that are already in the cache map (including
+        # tombstones of objects that don't exist)
         if document_class in cache_map:
             ids -= set(cache_map[document_class])
 
+        # move objects from the identity map to the cache map
+        if identity_map is not None:
+            for pk in list(ids):
+                obj = identity_map.get(document_class, pk)
+                if obj is not None:
+                    cache_map.setdefault(document_class, {})[pk] = obj
+                    ids.discard(pk)
+
         # no point setting up the data structures for fields where there's nothing to fetch
         if not ids:
-            continue
+            return
 
         # set up cache maps for the newly seen document class
         if document_class not in cache_map:
@@ -271,73 +1080,158 @@ def fetch_related(objs, field_dict, cache_map=None):
         if document_class not in partial_cache_map:
             partial_cache_map[document_class] = {}
 
-        # set up a fetch map for this document class
+        # set up a fetch map for this document class. If the same
+        # document class is requested with different fields_to_fetch
+        # (e.g. { user: ["id"], created_by: ["email"] }), we fetch a
+        # union of all the requested fields, or whole documents if any
+        # of the fields asks for them (e.g. { user: ["id"], created_by: True })
+        fields_to_fetch = None if fields_to_fetch is None else set(fields_to_fetch)
         if document_class in fetch_map:
-            fetch_map[document_class]['ids'] |= ids
-
-            # make sure we don't allow partial fetching if the same document class
-            # has conflicting fields_to_fetch (e.g. { user: ["id"], created_by: True })
-            # TODO this could be improved to fetch a union of all requested fields
-            if fields_to_fetch !=  fetch_map[document_class]['fields_to_fetch']:
-                raise RuntimeError('Cannot specify different fields_to_fetch for the same document class %s' % document_class)
+            fetch_opts = fetch_map[document_class]
+            fetch_opts['ids'] |= ids
+            if fields_to_fetch is None:
+                fetch_opts['fields_to_fetch'] = None
+            elif fetch_opts['fields_to_fetch'] is not None:
+                fetch_opts['fields_to_fetch'] |= fields_to_fetch
         else:
             fetch_map[document_class] = {
                 'ids': ids,
                 'fields_to_fetch': fields_to_fetch
             }
 
-    # Fetch objects and cache them
-    for document_class, fetch_opts in fetch_map.iteritems():
-        qs = document_class.objects.filter(pk__in=fetch_opts['ids']).clear_initial_query()
+    def _fetch_documents(self, fetch_map):
+        """
+        Fetches the documents in the given fetch map and returns a list of
+        (document class, fields to fetch, { pk: obj }) tuples, one for each
+        query that was made.
+        """
+        queries = []
+        for document_class, fetch_opts in fetch_map.iteritems():
+            ids = list(fetch_opts['ids'])
+            chunks = grouper(self.chunk_size, ids) if self.chunk_size else [ids]
+            queries.extend((document_class, chunk, fetch_opts['fields_to_fetch']) for chunk in chunks)
 
-        # only fetch the requested fields
-        if fetch_opts['fields_to_fetch']:
-            qs = qs.only(*fetch_opts['fields_to_fetch'])
+        if self.max_workers <= 1 or len(queries) <= 1:
+            return map(_fetch_documents_chunk, queries)
 
-        # update the cache map - either the persistent one with full objects,
-        # or the ephemeral partial cache
-        update_dict = { obj.pk: obj for obj in qs }
-        if fetch_opts['fields_to_fetch'] is None:
-            cache_map[document_class].update(update_dict)
-        else:
-            partial_cache_map[document_class].update(update_dict)
+        # The pool size bounds the number of queries in flight
+        pool = ThreadPool(min(self.max_workers, len(queries)))
+        try:
+            return list(pool.imap_unordered(_fetch_documents_chunk, queries))
+        finally:
+            pool.terminate()
+            pool.join()
 
-    # Assign objects
-    for field_name, sub_field_dict in field_dict.iteritems():
-        field, db_field, document_class, fields_to_fetch = field_info.get(field_name) or (None, None, None, None)
 
-        if not field:
-            continue
+def _fetch_documents_chunk(query):
+    document_class, ids, fields_to_fetch = query
+    qs = document_class.objects.filter(pk__in=ids).clear_initial_query()
 
-        # merge the permanent and temporary caches for the ease of assignment
-        pk_to_obj = cache_map.get(document_class, {}).copy()
-        pk_to_obj.update(partial_cache_map.get(document_class, {}))
+    # only fetch the requested fields
+    if fields_to_fetch:
+        qs = qs.only(*sorted(fields_to_fetch))
 
-        # if a dict of subfields was passed, go recursive
-        if pk_to_obj and isinstance(sub_field_dict, dict):
-            fetch_related(pk_to_obj.values(), sub_field_dict, cache_map=cache_map)
+    return document_class, fields_to_fetch, { obj.pk: obj for obj in qs }
 
-        # attach all the values to all the objects
-        for obj in objs:
-            if isinstance(field, SafeReferenceField):
-                if field_name not in obj._internal_data:
-                    val = obj._db_data.get(db_field, None)
-                    if val:
-                        setattr_unchanged(obj, field_name,
-                                pk_to_obj.get(id_from_value(field, val)))
 
-            elif isinstance(field, ReferenceField):
-                val = getattr(obj, field_name, None)
-                if val and getattr(val, '_lazy', False):
-                    rel_obj = pk_to_obj.get(val.pk)
-                    if rel_obj:
-                        setattr_unchanged(obj, field_name, rel_obj)
+# Compiled fetch plans by frozen field_dict, see compile_fetch_plan
+_fetch_plan_cache = {}
+_FETCH_PLAN_CACHE_SIZE = 1000
+
+def compile_fetch_plan(field_dict, **kwargs):
+    """
+    Compiles a fetch_related field_dict into a FetchPlan. Plans are cached,
+    so repeated calls with equal field_dicts (and options) return the same
+    plan. Any kwargs (chunk_size, max_workers) are passed to the FetchPlan,
+    e.g.:
+
+    fetch_related(objs, compile_fetch_plan({ 'user': True }, chunk_size=1000, max_workers=4))
+    """
+    try:
+        key = (freeze(field_dict), freeze(kwargs))
+        plan = _fetch_plan_cache.get(key)
+    except TypeError: # unhashable field_dict contents, don't cache
+        return FetchPlan(field_dict, **kwargs)
+
+    if plan is None:
+        if len(_fetch_plan_cache) >= _FETCH_PLAN_CACHE_SIZE:
+            _fetch_plan_cache.clear()
+        plan = _fetch_plan_cache[key] = FetchPlan(field_dict, **kwargs)
+    return plan
+
+
+def fetch_related(objs, field_dict, cache_map=None):
+    """
+    Recursively fetches related objects for the given document instances.
+    Sample usage:
+
+    fetch_related(objs, {
+        'user': True,
+        'lead': {
+            'created_by': True,
+            'updated_by': True,
+        },
+        'contact': ['id'],
+    })
+
+    In this sample, users and leads for all objs will be fetched and attached.
+    Then, lead.created_by and lead.updated_by users are fetched in one query
+    and attached. Finally, a contact will be pulled in, only fetching the ID
+    from the database.
+
+    objs may contain LazyReference proxies of a ReferenceLoader (see
+    flask_common.loader). They're resolved first, and the ones of documents
+    that don't exist are skipped.
+
+    Supported fields are ReferenceField, SafeReferenceField,
+    SafeReferenceListField, GenericReferenceField and ListFields of
+    (generic) references. Generic references are fetched with one query per
+    referenced document class. References in embedded documents can be
+    fetched with a dotted path through EmbeddedDocumentFields and lists of
+    embedded documents, e.g. 'addresses.owner'. A plain ListField is only
+    assigned if all of its references exist.
+
+    The field_dict is compiled into a FetchPlan and related objects are
+    fetched breadth-first: all the fields at the same nesting level are
+    fetched together, with one query per document class. The number of
+    queries thus depends on how deep the field_dict is rather than how many
+    fields it names. A compiled plan (see compile_fetch_plan) can be passed
+    instead of the field_dict, e.g. to split huge ID sets into chunks that
+    are fetched concurrently. The function never fetches the same related
+    object twice.
+
+    Be *very* cautious when pulling in only specific fields for a related
+    object. Accessing fields that haven't been pulled will falsely show None
+    even if a value for that field exists in the database.
+
+    If the same document class is requested with different fields (at the
+    same nesting level), a single query fetches the union of those fields, or
+    whole documents if any of the fields asks for them. Each field is then
+    assigned its object from that query.
 
-            elif isinstance(field, SafeReferenceListField):
-                if field_name not in obj._internal_data:
-                    value = filter(None, [pk_to_obj.get(id_from_value(field.field, val))
-                            for val in obj._db_data.get(db_field, [])])
-                    setattr_unchanged(obj, field_name, value)
+    Given how fragile partially pulled objects are, we don't cache them in the
+    cache map and hence the same related object may be fetched more than once.
+
+    If you need to call fetch_related multiple times, it's worth passing a
+    cache_map (initially it can be an empty dictionary). It will be extended
+    during each call to include all the objects fetched up until the current
+    call. This way we ensure that the same objects aren't fetched more than
+    once across multiple fetch_related calls. Cache map has a form of:
+    { DocumentClass: { id_of_fetched_obj: obj, id_of_fetched_obj2: obj2 } }.
+    IDs of objects that don't exist (e.g. deleted objects a SafeReferenceField
+    still points at) are cached as tombstones with a value of None, so they
+    aren't queried again either.
+
+    Returns a dict of the number of broken references (i.e. references to
+    objects that don't exist) by field path, e.g. { 'lead.created_by': 2 }.
+    Fields without broken references are omitted.
+    """
+
+    if not objs:
+        return {}
+
+    plan = field_dict if isinstance(field_dict, FetchPlan) else compile_fetch_plan(field_dict)
+    return plan.fetch(objs, cache_map=cache_map)
 
 
 class ForbiddenQueryException(Exception):
@@ -363,29 +1257,55 @@ class ForbiddenQueriesQuerySet(QuerySet):
         'max_allowed_limit': int or None
     }
 
+    The rules are indexed by their query shape, so to change them, assign a
+    new list to forbidden_queries instead of modifying the existing one.
+
     You can mark *any* queryset as safe with `mark_as_safe`.
     """
     forbidden_queries = None  # override this in a subclass
 
     _marked_as_safe = False
 
+    # Per queryset (clone) caches, see _check_for_forbidden_queries.
+    _is_testing = None
+    _frozen_query_shape = None
+    _checked_cursor = None
+
+    @classmethod
+    def _get_forbidden_queries_by_shape(cls):
+        """
+        Returns a dict of the forbidden queries keyed by their frozen query
+        shapes. Rebuilt whenever forbidden_queries is replaced (rules that are
+        changed in place aren't picked up).
+        """
+        forbidden_queries = cls.forbidden_queries
+        index = cls.__dict__.get('_forbidden_queries_index')
+        if index is None or index[0] is not forbidden_queries:
+            by_shape = {}
+            for forbidden in forbidden_queries or []:
+                by_shape.setdefault(freeze(forbidden['query_shape']), []).append(forbidden)
+            index = (forbidden_queries, by_shape)
+            cls._forbidden_queries_index = index
+        return index[1]
+
     def _check_for_forbidden_queries(self, idx_key=None):
         # idx_key can be a slice or an int from Doc.objects[idx_key]
-        is_testing = False
-        try:
-            is_testing = current_app.testing
-        except RuntimeError:
-            pass
+        if self._is_testing is None:
+            try:
+                self._is_testing = bool(current_app.testing)
+            except RuntimeError:
+                self._is_testing = False
 
-        if self._marked_as_safe or self._none or is_testing:
+        if self._marked_as_safe or self._none or self._is_testing:
             return
 
-        query_shape = self._get_query_shape(self._query)
-        for forbidden in self.forbidden_queries:
-            if (
-                query_shape == forbidden['query_shape'] and
-                (not forbidden.get('orderings') or self._ordering in forbidden['orderings'])
-            ):
+        # Querysets are cloned when they're filtered, so the shape of a
+        # queryset's query doesn't change.
+        if self._frozen_query_shape is None:
+            self._frozen_query_shape = freeze(self._get_query_shape(self._query))
+
+        for forbidden in self._get_forbidden_queries_by_shape().get(self._frozen_query_shape, ()):
+            if not forbidden.get('orderings') or self._ordering in forbidden['orderings']:
 
                 # determine the real limit based on objects.limit or objects[idx_key]
                 limit = self._limit
@@ -403,7 +1323,12 @@ class ForbiddenQueriesQuerySet(QuerySet):
                     )
 
     def next(self):
-        self._check_for_forbidden_queries()
+        # The query is checked once per cursor, i.e. only on the first next()
+        if self._checked_cursor is None or self._checked_cursor is not self._cursor_obj:
+            self._check_for_forbidden_queries()
+            doc = super(ForbiddenQueriesQuerySet, self).next()
+            self._checked_cursor = self._cursor_obj
+            return doc
         return super(ForbiddenQueriesQuerySet, self).next()
 
     def __getitem__(self, key):
@@ -419,27 +1344,258 @@ class ForbiddenQueriesQuerySet(QuerySet):
         return self
 
     def _get_query_shape(self, query):
+        return get_query_shape(query)
+
+
+class QueryStats(object):
+    """
+    Thread-safe, in-process statistics of queries per document class, query
+    shape, sort and limit, collected by TelemetryQuerySet.
+
+    For each of them, the number of queries, the total time spent fetching
+    documents, the 95th percentile of the time until the first document of
+    a query (i.e. of executing the query) and the number of documents
+    returned are kept. Memory is bounded: at most max_shapes entries are
+    kept (the entry with the least total time is dropped for a new one) and
+    the percentile is computed from the last max_samples queries.
+
+    If a dump hook is set (see set_dump_hook), it's called with all the
+    entries (see dump) every dump_interval seconds, and the statistics are
+    reset, e.g. to send them to a log or a metrics service.
+    """
+
+    def __init__(self, max_shapes=1000, max_samples=100):
+        self.max_shapes = max_shapes
+        self.max_samples = max_samples
+        self.dump_hook = None
+        self.dump_interval = None
+        self._last_dump = time.time()
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def set_dump_hook(self, hook, interval=60):
+        self.dump_hook = hook
+        self.dump_interval = interval
+        self._last_dump = time.time()
+
+    def get_key(self, doc_cls, query_shape, sort, limit):
+        # _class_name is unique, unlike __name__, and can be passed to
+        # mongoengine's get_document (e.g. 'Person.Programmer')
+        return (doc_cls._class_name, freeze(query_shape), freeze(sort), limit)
+
+    def record(self, doc_cls, query_shape, sort, limit, duration, docs,
+               new_query, key=None):
         """
-        Convert a query into a query shape, e.g.:
-        * { _cls: 'whatever' } into { _cls: 1 }
-        * { date: { $gte: '2015-01-01', $lte: '2015-01-31' } into { date: { $gte: 1, $lte: 1 } }
-        * { _cls: { $in: [ 'a', 'b', 'c' ] } } into { _cls: { $in: [] } }
+        Records `duration` seconds spent fetching `docs` documents of a query.
+        new_query is True for the first fetch of each query. The key (see
+        get_key) can be passed if it's known already.
         """
-        if not query:
-            return query
-
-        query_shape = {}
-        for key, val in query.items():
-            if isinstance(val, dict):
-                query_shape[key] = self._get_query_shape(val)
-            elif isinstance(val, (list, tuple)):
-                query_shape[key] = []
+        if key is None:
+            key = self.get_key(doc_cls, query_shape, sort, limit)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.max_shapes:
+                    min_key = min(self._entries, key=lambda k: self._entries[k]['total_time'])
+                    del self._entries[min_key]
+                entry = self._entries[key] = {
+                    'document': doc_cls._class_name,
+                    'query_shape': query_shape,
+                    'sort': sort,
+                    'limit': limit,
+                    'count': 0,
+                    'total_time': 0.0,
+                    'docs_returned': 0,
+                    'samples': [],
+                }
+            entry['total_time'] += duration
+            entry['docs_returned'] += docs
+            if new_query:
+                entry['count'] += 1
+                samples = entry['samples']
+                samples.append(duration)
+                if len(samples) > self.max_samples:
+                    del samples[0]
+
+        if self.dump_hook and time.time() - self._last_dump >= self.dump_interval:
+            self._last_dump = time.time()
+            stats = self.dump()
+            self.reset()
+            self.dump_hook(stats)
+
+    def dump(self):
+        """Returns a list of dicts with the statistics of each entry."""
+        with self._lock:
+            entries = [dict(entry) for entry in self._entries.values()]
+        for entry in entries:
+            samples = sorted(entry.pop('samples')) or [0.0]
+            entry['p95_time'] = samples[int((len(samples) - 1) * 0.95)]
+        return entries
+
+    def report(self, n=10, key='total_time'):
+        """Returns the top n entries of dump() by the given key."""
+        return sorted(self.dump(), key=lambda entry: entry[key], reverse=True)[:n]
+
+    def reset(self):
+        with self._lock:
+            self._entries = {}
+
+
+query_stats = QueryStats()
+
+
+class TelemetryQuerySet(QuerySet):
+    """
+    A queryset that records statistics of its queries in query_stats (see
+    QueryStats), so that costly query shapes can be found without using the
+    MongoDB profiler. Use it (or a subclass with its own query_stats) in a
+    Document's meta['queryset_class']. It can be combined with
+    ForbiddenQueriesQuerySet by subclassing both.
+
+    Only the time spent in the queryset is measured, not the time the
+    caller spends between fetching documents.
+    """
+
+    query_stats = query_stats
+
+    # Per queryset (clone) state
+    _telemetry_cursor = None
+    _telemetry_args = None
+    _telemetry_key = None
+
+    def _record_query_stats(self, duration, docs):
+        # The query doesn't change for a queryset (clone), so the arguments
+        # (including the key) are only computed once.
+        if self._telemetry_args is None:
+            query_shape = get_query_shape(self._query)
+            self._telemetry_args = (self._document, query_shape, self._ordering, self._limit)
+            self._telemetry_key = self.query_stats.get_key(*self._telemetry_args)
+
+        new_query = self._telemetry_cursor is None or self._telemetry_cursor is not self._cursor_obj
+        if new_query:
+            self._telemetry_cursor = self._cursor_obj
+
+        args = self._telemetry_args + (duration, docs, new_query)
+        self.query_stats.record(*args, key=self._telemetry_key)
+
+    def next(self):
+        start = time.time()
+        try:
+            doc = super(TelemetryQuerySet, self).next()
+        except StopIteration:
+            self._record_query_stats(time.time() - start, 0)
+            raise
+        self._record_query_stats(time.time() - start, 1)
+        return doc
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            # returns a clone which records its own queries
+            return super(TelemetryQuerySet, self).__getitem__(key)
+
+        start = time.time()
+        doc = super(TelemetryQuerySet, self).__getitem__(key)
+        self.query_stats.record(self._document, get_query_shape(self._query),
+                                self._ordering, 1, time.time() - start, 1, True)
+        return doc
+
+
+class AdaptiveBatchSizer(object):
+    """
+    Adaptive batch sizing for iter_no_cache(query_set, batch_sizer=...).
+
+    As the iteration runs, the size of the documents (sampled from each
+    batch) and the latency of fetching each batch (i.e. of each getMore)
+    are measured, and the size of the following batches is adjusted so that
+    a batch holds about target_bytes and is fetched in about target_latency
+    seconds. The batch size stays between min_batch_size and max_batch_size
+    and at most doubles from one batch to the next.
+
+    If given, stats_hook is called after each batch with a dict of the
+    measurements and the chosen batch size, e.g. to log them when tuning
+    exports of a collection.
+    """
+
+    def __init__(self, batch_size=1000, target_bytes=4 * 1024 * 1024,
+                 target_latency=1.0, min_batch_size=10, max_batch_size=10000,
+                 stats_hook=None):
+        self.batch_size = batch_size
+        self.target_bytes = target_bytes
+        self.target_latency = target_latency
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.stats_hook = stats_hook
+
+        # moving average of the document size in bytes
+        self.doc_bytes = None
+
+    def record_batch(self, docs, latency, doc_bytes=None):
+        """
+        Records the measurements of a fetched batch (number of documents,
+        seconds it took to fetch it and the size of a sampled document in
+        bytes) and returns the size of the next batch.
+        """
+        if doc_bytes:
+            if self.doc_bytes is None:
+                self.doc_bytes = float(doc_bytes)
             else:
-                query_shape[key] = 1
-        return query_shape
+                self.doc_bytes = (self.doc_bytes + doc_bytes) / 2.0
+
+        candidates = [self.max_batch_size, self.batch_size * 2]
+        if self.doc_bytes:
+            candidates.append(self.target_bytes / self.doc_bytes)
+        if docs and latency > 0:
+            candidates.append(docs * self.target_latency / latency)
+        next_batch_size = int(max(self.min_batch_size, min(candidates)))
+
+        if self.stats_hook:
+            self.stats_hook({
+                'batch_size': self.batch_size,
+                'docs': docs,
+                'latency': latency,
+                'doc_bytes': self.doc_bytes,
+                'next_batch_size': next_batch_size,
+            })
+
+        self.batch_size = next_batch_size
+        return next_batch_size
+
+
+def _iter_adaptive(query_set, batch_sizer):
+    query_set = query_set.batch_size(batch_sizer.batch_size)
+
+    # We need the private buffer of the pymongo cursor to know when the
+    # next call fetches a new batch (which happens when the buffer is empty)
+    # and to measure the raw documents, and its private batch size to apply
+    # the new one.
+    cursor = query_set._cursor
+    if not hasattr(cursor, '_Cursor__data') or not hasattr(cursor, '_Cursor__batch_size'):
+        raise NotImplementedError('Adaptive batch sizing is not supported for %s cursors'
+                                  % cursor.__class__.__name__)
+
+    while True:
+        if len(cursor._Cursor__data):
+            yield query_set.next()
+            continue
+
+        start = time.time()
+        doc = query_set.next()
+        latency = time.time() - start
 
+        # the cursor replaces its buffer with each batch
+        buffer = cursor._Cursor__data
+        batch_size = batch_sizer.record_batch(
+            docs=len(buffer) + 1,
+            latency=latency,
+            doc_bytes=len(BSON.encode(buffer[0])) if buffer else None,
+        )
 
-def iter_no_cache(query_set):
+        # applies to the next getMore
+        cursor._Cursor__batch_size = batch_size
+        yield doc
+
+
+def iter_no_cache(query_set, batch_sizer=None):
     """Iterate over queryset without caching it.
 
     Useful for iterating over large result sets / bulk actions.
@@ -447,9 +1603,281 @@ def iter_no_cache(query_set):
     If a batch size is not set, apply a sensible default of 1000
     that's better than what Mongo server is doing (101 first and
     then as many as it can fit in 4MB) to avoid cursor timeouts.
+
+    Pass an AdaptiveBatchSizer as batch_sizer to adjust the batch size
+    to the measured document size and fetch latency as the iteration runs.
+    This relies on internals of pymongo's Cursor and raises
+    NotImplementedError for cursors that don't have them.
     """
+    if batch_sizer is not None:
+        for doc in _iter_adaptive(query_set, batch_sizer):
+            yield doc
+        return
+
     if query_set._batch_size is None:
         query_set = query_set.batch_size(1000)
 
     while True:
         yield query_set.next()
+
+
+def partition_queryset(query_set, partitions, field=None, method='minmax', sample_size=None):
+    """
+    Splits a queryset into (at most) the given number of querysets, each of
+    them covering a disjoint range of values of an indexed field (the
+    primary key by default). Range boundaries are determined either by:
+
+    * 'minmax' - splitting the range between the minimum and the maximum
+      value evenly. Only works for numeric, datetime and ObjectId values.
+    * 'sample' - taking quantiles of a random sample of the values (20 per
+      partition by default). Works for any values, e.g. the string IDs of
+      a RandomPKDocument, but requires MongoDB 3.2+.
+    """
+    if query_set._limit is not None or query_set._skip is not None:
+        raise ValueError('Cannot partition a queryset with a limit or skip')
+
+    field = field or query_set._document._meta['id_field']
+    if partitions <= 1:
+        split_points = []
+    elif method == 'minmax':
+        split_points = _get_minmax_split_points(query_set, field, partitions)
+    elif method == 'sample':
+        split_points = _get_sampled_split_points(query_set, field, partitions,
+                                                 sample_size or 20 * partitions)
+    else:
+        raise ValueError('Unknown partitioning method: %s' % method)
+
+    # the first and the last partitions are open-ended so that values
+    # outside of the split points are covered, too
+    bounds = [None] + split_points + [None]
+    query_sets = []
+    for lower, upper in zip(bounds, bounds[1:]):
+        filters = {}
+        if lower is not None:
+            filters['%s__gte' % field] = lower
+        if upper is not None:
+            filters['%s__lt' % field] = upper
+        query_sets.append(query_set.clone().filter(**filters))
+    return query_sets
+
+
+def _get_minmax_split_points(query_set, field, partitions):
+    lower = query_set.clone().order_by(field).scalar(field).first()
+    upper = query_set.clone().order_by('-%s' % field).scalar(field).first()
+    if lower is None or upper is None or lower == upper:
+        return []
+
+    if isinstance(lower, ObjectId):
+        lower_num, upper_num = int(str(lower), 16), int(str(upper), 16)
+        points = [ObjectId('%024x' % (lower_num + (upper_num - lower_num) * i / partitions))
+                  for i in range(1, partitions)]
+    elif isinstance(lower, (int, long, float, datetime.datetime)):
+        points = [lower + (upper - lower) * i / partitions for i in range(1, partitions)]
+    else:
+        raise ValueError('Cannot split %s values by their min/max, use method="sample"' % type(lower).__name__)
+
+    return sorted(set(point for point in points if point > lower))
+
+
+def _get_sampled_split_points(query_set, field, partitions, sample_size):
+    doc_cls = query_set._document
+    db_field = doc_cls._db_field_map.get(field, field)
+    pipeline = [
+        { '$match': query_set._query },
+        { '$sample': { 'size': sample_size } },
+        { '$project': { db_field: 1 } },
+    ]
+    values = sorted(set(row[db_field] for row in query_set._collection.aggregate(pipeline, cursor={})
+                        if row.get(db_field) is not None))
+    if not values:
+        return []
+
+    # dedupe while keeping the database order (which might differ from the
+    # order of the python values, e.g. for an IDField)
+    points = []
+    for i in range(1, partitions):
+        point = values[len(values) * i / partitions]
+        if point not in points and point != values[0]:
+            points.append(point)
+    return [doc_cls._fields[field].to_python(value) for value in points]
+
+
+def _put_unless_stopped(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def iter_partitioned(query_set, partitions=4, max_workers=None, queue_size=1000, **kwargs):
+    """
+    Iterates over a queryset like iter_no_cache, but splits it into
+    partitions (see partition_queryset, which also receives any kwargs)
+    that are iterated concurrently by a pool of threads. Documents are
+    yielded in no particular order, through a bounded queue that limits the
+    number of documents held in memory.
+
+    Useful for full-collection passes (migrations, exports) that would
+    otherwise run at the speed of a single cursor.
+    """
+    query_sets = partition_queryset(query_set, partitions, **kwargs)
+    results = Queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def _iter_partition(partition_qs):
+        try:
+            for doc in iter_no_cache(partition_qs):
+                if not _put_unless_stopped(results, (doc, None), stop):
+                    return
+        except Exception:
+            _put_unless_stopped(results, (None, sys.exc_info()), stop)
+        _put_unless_stopped(results, (done, None), stop)
+
+    pool = ThreadPool(min(max_workers or len(query_sets), len(query_sets)))
+    try:
+        for partition_qs in query_sets:
+            pool.apply_async(_iter_partition, (partition_qs,))
+
+        remaining = len(query_sets)
+        while remaining:
+            doc, exc_info = results.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if doc is done:
+                remaining -= 1
+            else:
+                yield doc
+    finally:
+        # also stops the workers if the generator isn't exhausted
+        stop.set()
+        pool.terminate()
+        pool.join()
+
+
+def map_partitions(query_set, callback, partitions=4, max_workers=None, **kwargs):
+    """
+    Splits a queryset into partitions (see partition_queryset, which also
+    receives any kwargs) and concurrently calls callback(docs) for each of
+    them in a pool of threads, docs being an iter_no_cache iterator over the
+    partition. Returns a list of the callback results in partition order.
+    """
+    query_sets = partition_queryset(query_set, partitions, **kwargs)
+    pool = ThreadPool(min(max_workers or len(query_sets), len(query_sets)))
+    try:
+        return pool.map(lambda partition_qs: callback(iter_no_cache(partition_qs)),
+                        query_sets, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class FileCheckpointStore(object):
+    """
+    Stores iteration checkpoints (see iter_checkpointed) in a JSON file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json_util.loads(f.read())
+        except IOError:
+            return {}
+
+    def _save(self, checkpoints):
+        # write to a temporary file first so that a crash doesn't leave a
+        # corrupted checkpoint file behind
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as f:
+            f.write(json_util.dumps(checkpoints))
+        os.rename(tmp_path, self.path)
+
+    def get(self, name):
+        return self._load().get(name)
+
+    def set(self, name, value):
+        checkpoints = self._load()
+        checkpoints[name] = value
+        self._save(checkpoints)
+
+    def delete(self, name):
+        checkpoints = self._load()
+        if checkpoints.pop(name, None) is not None:
+            self._save(checkpoints)
+
+
+class MongoCheckpointStore(object):
+    """
+    Stores iteration checkpoints (see iter_checkpointed) in the given
+    (pymongo) collection.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get(self, name):
+        checkpoint = self.collection.find_one({ '_id': name })
+        return checkpoint and checkpoint['value']
+
+    def set(self, name, value):
+        self.collection.update({ '_id': name }, { '$set': {
+            'value': value,
+            'date_updated': datetime.datetime.utcnow(),
+        }}, upsert=True)
+
+    def delete(self, name):
+        self.collection.remove({ '_id': name })
+
+
+def iter_checkpointed(query_set, name=None, checkpoint_store=None,
+                      resume_from=None, field=None, batch_size=1000):
+    """
+    Iterate over a queryset in the order of a unique indexed field (the
+    primary key by default), using keyset pagination: each batch is fetched
+    with a new query for the documents following the last seen key, so no
+    server-side cursor lives longer than a single batch.
+
+    If a checkpoint_store (e.g. a FileCheckpointStore or a
+    MongoCheckpointStore) is given, the last seen key is saved there under
+    the given name after each batch is processed and the iteration resumes
+    from the saved checkpoint, so that a crashed or restarted job doesn't
+    reprocess anything. The checkpoint is deleted when the iteration
+    finishes. A checkpoint token (i.e. the last processed key) can also be
+    passed explicitly via resume_from.
+    """
+    if query_set._limit is not None or query_set._skip is not None:
+        raise ValueError('Cannot use checkpointed iteration on a queryset with a limit or skip')
+    if checkpoint_store is not None and not name:
+        raise ValueError('A name is required to store checkpoints')
+
+    field = field or query_set._document._meta['id_field']
+    last_key = resume_from
+    if last_key is None and checkpoint_store is not None:
+        last_key = checkpoint_store.get(name)
+
+    while True:
+        batch_qs = query_set.clone().order_by(field).limit(batch_size)
+        if last_key is not None:
+            batch_qs = batch_qs.filter(**{ '%s__gt' % field: last_key })
+
+        count = 0
+        for doc in iter_no_cache(batch_qs.batch_size(batch_size)):
+            count += 1
+            last_key = getattr(doc, field)
+            yield doc
+
+        if count < batch_size:
+            break
+
+        # the whole batch was processed by now
+        if checkpoint_store is not None:
+            checkpoint_store.set(name, last_key)
+
+    if checkpoint_store is not None:
+        checkpoint_store.delete(name)
@@ -2,7 +2,8 @@ import uuid
 
 from mongoengine import UUIDField
 
-from ..utils.id import id_to_uuid, uuid_to_id
+from ..utils.id import (generate_id, generate_time_ordered_id, id_to_uuid,
+                        uuid_to_id)
 
 
 try:
@@ -19,11 +20,16 @@ class IDField(UUIDField):
     underscore, followed by the zbase62-encoded ID.
 
     If autogenerate=True is passed to the constructor, a random ID is generated
-    and assigned to the field by default.
+    and assigned to the field by default. If time_ordered=True is passed as
+    well, the generated IDs are time-ordered UUIDs (see
+    flask_common.utils.id.time_ordered_uuid) instead, which keeps inserts
+    local in the index. Their creation time can be extracted with
+    flask_common.utils.id.id_to_datetime.
     """
     def __init__(self, **kwargs):
         self.prefix = kwargs.pop('prefix')
         self.autogenerate = kwargs.pop('autogenerate', False)
+        self.time_ordered = kwargs.pop('time_ordered', False)
         if self.autogenerate:
             if 'default' in kwargs:
                 raise RuntimeError('Can\'t use "default" with "autogenerate"')
@@ -31,7 +37,9 @@ class IDField(UUIDField):
         super(IDField, self).__init__(**kwargs)
 
     def generate_id(self):
-        return uuid_to_id(uuid.uuid4(), self.prefix)
+        if self.time_ordered:
+            return generate_time_ordered_id(str(self.prefix))
+        return generate_id(self.prefix)
 
     def to_python(self, value):
         if isinstance(value, uuid.UUID):
@@ -0,0 +1,157 @@
+"""
+A request-scoped identity map for MongoEngine documents.
+
+The identity map holds documents that were already loaded within the current
+Flask app context (which is pushed for each request), so that fetching the
+same document by its primary key again doesn't hit the database. It's used by
+fetch_related, fetch_document, IdentityMapQuerySet.get and db.MongoReference.
+
+Only documents whose meta['queryset_class'] is an IdentityMapQuerySet (such as
+NotDeletedQuerySet, which SoftDeleteDocument uses) are served from the map by
+Doc.objects.get(pk=...). Lazy ReferenceField and SafeReferenceField
+dereferences don't go through the map; use fetch_related to resolve them from
+it instead. Writes through DocumentBase, SoftDeleteDocument, bulk_update and
+IdentityMapQuerySet's update, modify and delete discard the affected entries.
+Writes that bypass these (e.g. a plain QuerySet's update or raw pymongo) can
+leave stale documents in the map until the app context ends.
+
+The identity map is opt-in. Enable it with the IDENTITY_MAP_ENABLED config
+option and optionally limit its size (defaults to 1000 documents) with
+IDENTITY_MAP_SIZE. Least recently used documents are evicted first.
+"""
+
+from collections import OrderedDict
+
+from flask import _app_ctx_stack
+
+
+__all__ = ['IdentityMap', 'get_identity_map', 'fetch_document',
+           'invalidate_document']
+
+
+DEFAULT_SIZE = 1000
+
+
+class IdentityMap(object):
+    """
+    LRU map of documents keyed by their collection and primary key, with
+    hit/miss counters.
+    """
+
+    def __init__(self, max_size=DEFAULT_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._docs = OrderedDict()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __repr__(self):
+        return '<IdentityMap: %d docs, %d hits, %d misses>' % (
+            len(self._docs), self.hits, self.misses)
+
+    def _key(self, doc_cls, pk):
+        return (doc_cls._get_collection_name(), pk)
+
+    def get(self, doc_cls, pk):
+        """
+        Returns the document of the given class with the given pk, or None if
+        it's not in the map.
+        """
+        key = self._key(doc_cls, pk)
+        obj = self._docs.get(key)
+
+        # The collection may be shared by a class hierarchy, so make sure we
+        # don't return e.g. a Person when a Programmer was asked for.
+        if obj is None or not isinstance(obj, doc_cls):
+            self.misses += 1
+            return None
+
+        # mark as most recently used
+        del self._docs[key]
+        self._docs[key] = obj
+
+        self.hits += 1
+        return obj
+
+    def add(self, obj):
+        """Adds a (fully loaded) document to the map."""
+        if obj is None or obj.pk is None:
+            return
+        # obj.__class__ is the document class for LazyReference proxies too
+        key = self._key(obj.__class__, obj.pk)
+        self._docs.pop(key, None)
+        self._docs[key] = obj
+        while len(self._docs) > self.max_size:
+            self._docs.popitem(last=False)
+
+    def discard(self, doc_cls, pk):
+        """Removes the document of the given class with the given pk."""
+        self._docs.pop(self._key(doc_cls, pk), None)
+
+    def discard_all(self, doc_cls):
+        """
+        Removes all the documents stored in the collection of the given class.
+        """
+        collection_name = doc_cls._get_collection_name()
+        for key in [key for key in self._docs if key[0] == collection_name]:
+            del self._docs[key]
+
+    def get_or_fetch(self, doc_cls, pk, fetch):
+        """
+        Returns the document of the given class with the given pk. If it's not
+        in the map, it's fetched by calling `fetch` and added to the map.
+        """
+        obj = self.get(doc_cls, pk)
+        if obj is None:
+            obj = fetch()
+            self.add(obj)
+        return obj
+
+    def clear(self):
+        self._docs.clear()
+
+
+def get_identity_map():
+    """
+    Returns the identity map of the current app context, or None if there's
+    no app context or the identity map isn't enabled.
+    """
+    ctx = _app_ctx_stack.top
+    if ctx is None:
+        return None
+
+    identity_map = getattr(ctx, 'flask_common_identity_map', None)
+    if identity_map is None:
+        config = ctx.app.config
+        if not config.get('IDENTITY_MAP_ENABLED'):
+            return None
+        identity_map = IdentityMap(config.get('IDENTITY_MAP_SIZE', DEFAULT_SIZE))
+        ctx.flask_common_identity_map = identity_map
+    return identity_map
+
+
+def fetch_document(doc_cls, pk):
+    """
+    Like doc_cls.objects.get(pk=pk), but checks the identity map first and
+    fills it after querying.
+    """
+    queryset = doc_cls.objects
+    identity_map = get_identity_map()
+
+    # Querysets that use the identity map themselves handle it in get()
+    if identity_map is None or getattr(queryset, 'uses_identity_map', False):
+        return queryset.get(pk=pk)
+
+    return identity_map.get_or_fetch(doc_cls, pk, lambda: queryset.get(pk=pk))
+
+
+def invalidate_document(obj):
+    """
+    Removes the given document from the identity map, e.g. because it was
+    modified.
+    """
+    identity_map = get_identity_map()
+    if identity_map is not None and obj.pk is not None:
+        identity_map.discard(obj.__class__, obj.pk)
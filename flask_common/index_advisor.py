@@ -0,0 +1,316 @@
+"""
+An index advisor for MongoEngine documents.
+
+It explains queries (e.g. the query shapes recorded by a TelemetryQuerySet
+during a test run), flags collection scans, in-memory sorts and queries
+that examine many more documents than they return, and proposes compound
+indexes in the format of a Document's meta['indexes'].
+
+If the database can't explain a query (e.g. mongomock, or a query shape
+that isn't a valid query, like {'$or': []}), the plan is estimated from the
+existing and declared indexes instead.
+
+StrictIndexQuerySet can be used in tests to fail queries that scan whole
+collections.
+"""
+
+from mongoengine import QuerySet
+from mongoengine.base import get_document
+from pymongo.errors import OperationFailure
+
+from .utils.objects import get_query_shape
+
+
+__all__ = ['IndexAdvisor', 'StrictIndexQuerySet', 'CollectionScanException']
+
+
+# Operators that select a range of values of a field (as opposed to an
+# equality match).
+RANGE_OPERATORS = set(['$gt', '$gte', '$lt', '$lte', '$ne', '$nin', '$exists',
+                       '$regex', '$not', '$type', '$mod', '$size', '$all'])
+
+
+class CollectionScanException(Exception):
+    """Exception raised by StrictIndexQuerySet"""
+
+
+def _sort_list(sort):
+    # pymongo wants a list of (key, direction) tuples
+    if not sort:
+        return []
+    if isinstance(sort, dict):
+        return list(sort.items())
+    return list(sort)
+
+
+def _plan_stages(plan):
+    stages = []
+    while plan:
+        stages.append(plan.get('stage'))
+        for child in plan.get('inputStages', []):
+            stages.extend(_plan_stages(child))
+        plan = plan.get('inputStage')
+    return stages
+
+
+def _parse_explain(explain):
+    """
+    Returns a dict with the relevant parts of the given explain output of
+    either MongoDB 3.x or 2.x.
+    """
+    if 'queryPlanner' in explain:
+        stages = _plan_stages(explain['queryPlanner']['winningPlan'])
+        stats = explain.get('executionStats', {})
+        return {
+            'collscan': 'COLLSCAN' in stages,
+            'in_memory_sort': 'SORT' in stages,
+            'keys_examined': stats.get('totalKeysExamined'),
+            'docs_examined': stats.get('totalDocsExamined'),
+            'returned': stats.get('nReturned'),
+        }
+    return {
+        'collscan': explain.get('cursor', '').startswith('BasicCursor'),
+        'in_memory_sort': bool(explain.get('scanAndOrder')),
+        'keys_examined': explain.get('nscanned'),
+        'docs_examined': explain.get('nscannedObjects'),
+        'returned': explain.get('n'),
+    }
+
+
+def _explain(collection, query, sort=None, limit=None):
+    cursor = collection.find(query)
+    if sort:
+        cursor = cursor.sort(_sort_list(sort))
+    if limit:
+        cursor = cursor.limit(limit)
+    return cursor.explain()
+
+
+def _query_fields(query):
+    """
+    Returns a tuple of the lists of the fields of the given query (or shape)
+    that are matched by equality and by range. The clauses of an $and are
+    merged, and fields matched in every clause of an $or are treated like
+    an $in, i.e. as ranges.
+    """
+    equality, ranges = [], []
+
+    def add(fields, field):
+        if field not in equality and field not in ranges:
+            fields.append(field)
+
+    for key, val in query.items():
+        if key == '$and' and isinstance(val, (list, tuple)):
+            for clause in val:
+                clause_equality, clause_ranges = _query_fields(clause)
+                for field in clause_equality:
+                    add(equality, field)
+                for field in clause_ranges:
+                    add(ranges, field)
+        elif key == '$or' and isinstance(val, (list, tuple)) and val:
+            clause_fields = [set(sum(_query_fields(clause), [])) for clause in val]
+            for field in sorted(set.intersection(*clause_fields)):
+                add(ranges, field)
+        elif key.startswith('$'):
+            continue
+        elif isinstance(val, dict) and any(op in RANGE_OPERATORS for op in val):
+            add(ranges, key)
+        else:
+            add(equality, key)
+    return equality, ranges
+
+
+class IndexAdvisor(object):
+    """
+    Explains queries of document classes and proposes indexes for the ones
+    that scan the collection, sort in memory, or examine more than
+    max_ratio documents per returned document.
+    """
+
+    def __init__(self, max_ratio=10):
+        self.max_ratio = max_ratio
+
+    def get_indexes(self, doc_cls):
+        """
+        Returns the keys (lists of (field, direction) tuples) of the existing
+        and declared indexes of the given document class.
+        """
+        keys = [[('_id', 1)]]
+        try:
+            keys.extend(info['key'] for info in doc_cls._get_collection().index_information().values())
+        except NotImplementedError:
+            pass
+        keys.extend(spec['fields'] for spec in doc_cls._meta.get('index_specs') or [])
+        return keys
+
+    def _estimate(self, doc_cls, query, sort):
+        # Estimates the plan from the indexes, assuming the query planner
+        # picks an index whose first field is queried.
+        equality, ranges = _query_fields(query)
+        sort = _sort_list(sort)
+
+        # The clauses of logical operators are lost in query shapes (e.g.
+        # {'$or': []}), so we can't tell whether they'd use an index.
+        unknown = not equality and not ranges and \
+            any(key in ('$and', '$or', '$nor') and not val for key, val in query.items())
+        collscan = None if unknown else True
+
+        in_memory_sort = bool(sort)
+        for key in self.get_indexes(doc_cls):
+            fields = [field for field, direction in key]
+            if fields[0] in equality or fields[0] in ranges:
+                collscan = False
+            if sort and self._supports_sort(key, equality, sort):
+                in_memory_sort = False
+        return {
+            'collscan': collscan,
+            'in_memory_sort': in_memory_sort,
+            'keys_examined': None,
+            'docs_examined': None,
+            'returned': None,
+        }
+
+    def _supports_sort(self, key, equality, sort):
+        # The index can be used for the sort if it starts with (some of) the
+        # equality fields followed by the sort fields, in the same or the
+        # reverse directions.
+        key = list(key)
+        while key and key[0][0] in equality and key[0][0] not in [field for field, direction in sort]:
+            key.pop(0)
+        key = key[:len(sort)]
+        reverse = [(field, -direction) for field, direction in sort]
+        return key == sort or key == reverse
+
+    def suggest_index(self, doc_cls, query, sort=None):
+        """
+        Proposes an index for the given query and sort following the
+        equality, sort, range rule, as a meta['indexes'] spec, or returns None
+        if an existing or declared index already starts with it.
+        """
+        equality, ranges = _query_fields(query)
+        sort = _sort_list(sort)
+        key = [(field, 1) for field in equality if field != '_cls']
+        key += [(field, direction) for field, direction in sort if field not in equality]
+        key += [(field, 1) for field in ranges if field not in [k for k, d in key]]
+        if not key:
+            return None
+
+        for index in self.get_indexes(doc_cls):
+            index = [(field, direction) for field, direction in index if field != '_cls']
+            if index[:len(key)] in (key, [(field, -direction) for field, direction in key]):
+                return None
+
+        reverse_map = getattr(doc_cls, '_reverse_db_field_map', {})
+        return {
+            'fields': [('-' if direction < 0 else '') + reverse_map.get(field, field)
+                       for field, direction in key],
+        }
+
+    def analyze(self, doc_cls, query, sort=None, limit=None):
+        """
+        Explains the given query (or query shape) and returns a dict
+        describing its plan, the problems found (collscan, in_memory_sort,
+        poor_ratio) and a suggested index if there are any. If the plan is
+        estimated, collscan is None when it can't be determined.
+        """
+        try:
+            result = _parse_explain(_explain(doc_cls._get_collection(), query, sort, limit))
+            result['estimated'] = False
+        except (AttributeError, NotImplementedError, OperationFailure):
+            result = self._estimate(doc_cls, query, sort)
+            result['estimated'] = True
+
+        problems = []
+        if result['collscan']:
+            problems.append('collscan')
+        if result['in_memory_sort']:
+            problems.append('in_memory_sort')
+        if result['docs_examined'] is not None and \
+                result['docs_examined'] > self.max_ratio * max(result['returned'], 1):
+            problems.append('poor_ratio')
+
+        result.update({
+            'document': doc_cls._class_name,
+            'query': query,
+            'sort': sort,
+            'limit': limit,
+            'problems': problems,
+            'suggested_index': self.suggest_index(doc_cls, query, sort) if problems else None,
+        })
+        return result
+
+    def analyze_query_stats(self, query_stats):
+        """
+        Analyzes the query shapes recorded in the given QueryStats (e.g.
+        during a test run) and returns the analyses that found problems.
+        The shapes are used as queries, and the plans of shapes that aren't
+        valid queries are estimated.
+        """
+        results = []
+        for entry in query_stats.dump():
+            result = self.analyze(get_document(entry['document']),
+                                  entry['query_shape'] or {},
+                                  entry['sort'], entry['limit'])
+            if result['problems']:
+                result['count'] = entry['count']
+                results.append(result)
+        return results
+
+
+class StrictIndexQuerySet(QuerySet):
+    """
+    A queryset which explains each query before it's executed (by iterating,
+    indexing, slicing or counting) and raises a CollectionScanException if it
+    would scan a whole collection with at least strict_min_collection_size
+    documents. Counts of all the documents aren't checked since they don't
+    scan the collection. Meant for tests: set
+    strict_min_collection_size in a subclass (or on this class in the test
+    setup) and use the class in a Document's meta['queryset_class'].
+    """
+    strict_min_collection_size = None  # disabled by default
+
+    _strict_checked_cursor = None
+
+    def _check_for_collection_scan(self):
+        if self.strict_min_collection_size is None or self._none:
+            return
+
+        collection = self._collection
+        size = collection.count()
+        if size < self.strict_min_collection_size:
+            return
+
+        result = IndexAdvisor().analyze(self._document, self._query,
+                                        self._ordering, self._limit)
+        if result['collscan']:
+            raise CollectionScanException(
+                'Collection scan on %s (%d documents)! Query: %s, Ordering: %s, '
+                'Suggested index: %s' % (collection.name, size, get_query_shape(self._query),
+                                         self._ordering, result['suggested_index'])
+            )
+
+    def next(self):
+        # only the first next() of a cursor executes the query
+        if self._strict_checked_cursor is None or self._strict_checked_cursor is not self._cursor_obj:
+            self._check_for_collection_scan()
+            doc = super(StrictIndexQuerySet, self).next()
+            self._strict_checked_cursor = self._cursor_obj
+            return doc
+        return super(StrictIndexQuerySet, self).next()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            # returns a clone with its own cursor, checked right away
+            queryset = super(StrictIndexQuerySet, self).__getitem__(key)
+            queryset._check_for_collection_scan()
+            queryset._strict_checked_cursor = queryset._cursor_obj
+            return queryset
+
+        # e.g. first()
+        self._check_for_collection_scan()
+        return super(StrictIndexQuerySet, self).__getitem__(key)
+
+    def count(self, *args, **kwargs):
+        if self._query:
+            self._check_for_collection_scan()
+        return super(StrictIndexQuerySet, self).count(*args, **kwargs)
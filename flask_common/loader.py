@@ -0,0 +1,228 @@
+"""
+DataLoader-style batching of lazy references.
+
+A ReferenceLoader hands out LazyReference proxies for (document class, pk)
+pairs and queues their IDs. At the first access of an attribute of a proxy
+(other than pk), all the queued IDs of its document class are fetched with a
+single $in query. Code that collects references before touching them, e.g.
+
+users = [row.user for row in rows]
+names = [user.name for user in users]
+
+thus makes one query per document class instead of one per reference.
+
+Fetched documents are kept in the loader's cache_map, which has the same
+form as the one of fetch_related, so the two can share it:
+{ DocumentClass: { id_of_fetched_obj: obj, id_of_fetched_obj2: obj2 } }.
+Like in fetch_related, IDs of documents that don't exist are cached with a
+value of None.
+The identity map (see flask_common.identity_map) is used as well. Writes
+through DocumentBase/SoftDeleteDocument (and the bulk helpers of
+flask_common.documents) discard the written documents from the loader of the
+app context.
+
+The loader is opt-in. Enable it with the REFERENCE_LOADER_ENABLED config
+option to make db.MongoReference return LazyReference proxies within the app
+context (e.g. a request). Note that a proxy of a document that doesn't exist
+only raises DoesNotExist when its attributes are accessed.
+"""
+
+from flask import _app_ctx_stack
+
+from .identity_map import get_identity_map
+
+
+__all__ = ['ReferenceLoader', 'LazyReference', 'get_reference_loader',
+           'resolve_reference']
+
+
+def _to_pk(document_class, value):
+    # e.g. MongoReference IDs of ObjectId primary keys are strings
+    return document_class._fields[document_class._meta['id_field']].to_python(value)
+
+
+class LazyReference(object):
+    """
+    Proxy of a document which is fetched by its ReferenceLoader on first
+    access. It passes isinstance checks for the document class and compares
+    equal to the document.
+    """
+    __slots__ = ('_loader', '_document_class', '_pk', '_obj')
+
+    def __init__(self, loader, document_class, pk):
+        object.__setattr__(self, '_loader', loader)
+        object.__setattr__(self, '_document_class', document_class)
+        object.__setattr__(self, '_pk', pk)
+        object.__setattr__(self, '_obj', None)
+
+    def _resolve(self):
+        obj = self._obj
+        if obj is None:
+            obj = self._loader.get(self._document_class, self._pk)
+            object.__setattr__(self, '_obj', obj)
+        return obj
+
+    @property
+    def __class__(self):
+        return self._document_class
+
+    @property
+    def pk(self):
+        return self._pk
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyReference):
+            other = other._resolve()
+        return self._resolve() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self._resolve())
+
+    def __nonzero__(self):
+        return True
+
+    def __repr__(self):
+        if self._obj is not None:
+            return repr(self._obj)
+        return '<LazyReference: %s %s>' % (self._document_class.__name__, self._pk)
+
+
+class ReferenceLoader(object):
+    """
+    Queues the IDs of lazily loaded documents and fetches them with one query
+    per document class. See the module docstring.
+    """
+
+    def __init__(self, cache_map=None):
+        self.cache_map = {} if cache_map is None else cache_map
+
+        # IDs to fetch by document class
+        self._queued = {}
+
+    def load(self, document_class, pk):
+        """
+        Returns the document of the given class with the given pk if it was
+        already fetched, or a LazyReference proxy of it otherwise.
+        """
+        pk = _to_pk(document_class, pk)
+        obj = self.cache_map.get(document_class, {}).get(pk)
+        if obj is not None:
+            return obj
+        self._queued.setdefault(document_class, set()).add(pk)
+        return LazyReference(self, document_class, pk)
+
+    def load_many(self, document_class, pks):
+        return [self.load(document_class, pk) for pk in pks]
+
+    def resolve(self, document_class):
+        """
+        Fetches all the queued documents of the given class with one query.
+        """
+        ids = self._queued.pop(document_class, None)
+        if not ids:
+            return
+
+        cache = self.cache_map.setdefault(document_class, {})
+        ids -= set(cache)
+
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            for pk in list(ids):
+                obj = identity_map.get(document_class, pk)
+                if obj is not None:
+                    cache[pk] = obj
+                    ids.discard(pk)
+
+        if not ids:
+            return
+
+        qs = document_class.objects.filter(pk__in=list(ids)).clear_initial_query()
+        for obj in qs:
+            cache[obj.pk] = obj
+            if identity_map is not None:
+                identity_map.add(obj)
+
+        # tombstones of documents that don't exist, like in fetch_related
+        for pk in ids:
+            cache.setdefault(pk, None)
+
+    def _get_caches(self, document_class):
+        # The cached classes may be different classes of the same collection
+        collection_name = document_class._get_collection_name()
+        return [(cls, cache) for cls, cache in self.cache_map.items()
+                if cls._get_collection_name() == collection_name]
+
+    def discard(self, document_class, pk):
+        """
+        Removes the cached document (or tombstone) with the given pk from the
+        collection of the given class, e.g. because it was modified.
+        """
+        if pk is None:
+            return
+        for cls, cache in self._get_caches(document_class):
+            cache.pop(_to_pk(cls, pk), None)
+
+    def discard_all(self, document_class):
+        """
+        Removes all the cached documents (and tombstones) of the collection
+        of the given class.
+        """
+        for cls, cache in self._get_caches(document_class):
+            cache.clear()
+
+    def get(self, document_class, pk):
+        """
+        Returns the document of the given class with the given pk, fetching
+        it along with the other queued documents of its class if needed.
+        Raises DoesNotExist if it doesn't exist.
+        """
+        pk = _to_pk(document_class, pk)
+        if pk not in self.cache_map.get(document_class, {}):
+            self._queued.setdefault(document_class, set()).add(pk)
+            self.resolve(document_class)
+        obj = self.cache_map[document_class].get(pk)
+        if obj is None:
+            raise document_class.DoesNotExist('%s matching query does not exist.'
+                                              % document_class._class_name)
+        return obj
+
+
+def resolve_reference(obj):
+    """
+    Returns the document of the given LazyReference (fetching it along with
+    the other queued documents of its class if needed), or None if it doesn't
+    exist. Other objects are returned as they are.
+    """
+    if isinstance(obj, LazyReference):
+        try:
+            return obj._resolve()
+        except obj._document_class.DoesNotExist:
+            return None
+    return obj
+
+
+def get_reference_loader():
+    """
+    Returns the reference loader of the current app context, or None if
+    there's no app context or the loader isn't enabled.
+    """
+    ctx = _app_ctx_stack.top
+    if ctx is None:
+        return None
+
+    loader = getattr(ctx, 'flask_common_reference_loader', None)
+    if loader is None:
+        if not ctx.app.config.get('REFERENCE_LOADER_ENABLED'):
+            return None
+        loader = ReferenceLoader()
+        ctx.flask_common_reference_loader = loader
+    return loader
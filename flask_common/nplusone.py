@@ -0,0 +1,207 @@
+"""
+Detection of N+1 queries, i.e. of documents fetched one by one by their
+primary key, typically by lazily dereferencing a ReferenceField,
+SafeReferenceField or MongoReference of each object in a loop instead of
+fetching them at once with fetch_related or fetch_mongo_references.
+
+NPlusOneDetector is a query counter (see inprocess_query_counter) which
+groups the fetches by primary key by the fetched collection, the call site
+(the first frame outside of flask_common and the database libraries) and the
+dereferenced field. When a group has more than `threshold` fetches, it logs a
+warning or, with raise_errors=True, raises an NPlusOneException, which
+includes the fetch_related field_dict that would have fetched them at once.
+
+To check each request of an app, call init_nplusone_detection(app) and set
+the NPLUSONE_DETECTION config option, and optionally NPLUSONE_THRESHOLD
+(defaults to 5) and NPLUSONE_RAISE (e.g. in the test config, to fail tests
+that do N+1 queries).
+"""
+
+import logging
+import os
+import sys
+
+import mongoengine
+import pymongo
+import sqlalchemy
+from flask import _request_ctx_stack
+from mongoengine.base import BaseDocument, BaseField
+from sqlalchemy import inspect
+
+import flask_common
+from .db import MongoReferenceProperty, _get_reference
+from .utils.legacy import inprocess_query_counter
+
+
+__all__ = ['NPlusOneDetector', 'NPlusOneException', 'init_nplusone_detection']
+
+
+DEFAULT_THRESHOLD = 5
+
+logger = logging.getLogger(__name__)
+
+_internal_modules = [flask_common, mongoengine, pymongo, sqlalchemy]
+try:
+    import mongomock
+    _internal_modules.append(mongomock)
+except ImportError:
+    pass
+
+# Frames in these directories are skipped when looking for the call site.
+_INTERNAL_DIRS = tuple(os.path.dirname(os.path.abspath(module.__file__)) + os.sep
+                       for module in _internal_modules)
+
+_internal_files = {}
+
+
+class NPlusOneException(Exception):
+    """Exception raised by NPlusOneDetector"""
+
+
+def _is_internal(code):
+    internal = _internal_files.get(code.co_filename)
+    if internal is None:
+        internal = _internal_files[code.co_filename] = \
+            os.path.abspath(code.co_filename).startswith(_INTERNAL_DIRS)
+    return internal
+
+
+def _get_synonym_name(model, field):
+    # Returns the name of the MongoReference synonym of the given ID field
+    for name, synonym in inspect(model).synonyms.items():
+        if isinstance(synonym.descriptor, MongoReferenceProperty) and \
+                synonym.descriptor.field == field:
+            return name
+    return field
+
+
+def _get_dereference(frame):
+    """
+    Returns a tuple of the frame of the innermost lazy dereference (of a
+    document field or a MongoReference) the given frame is in, the class of
+    the object the reference was accessed on and the name of the reference,
+    or a tuple of Nones if the frame isn't in a dereference.
+    """
+    while frame is not None:
+        code = frame.f_code
+        if code is _get_reference.__code__:
+            model = type(frame.f_locals['obj'])
+            return frame, model, _get_synonym_name(model, frame.f_locals['field'])
+        if code.co_name == '__get__':
+            field = frame.f_locals.get('self')
+            instance = frame.f_locals.get('instance')
+            if isinstance(field, BaseField) and isinstance(instance, BaseDocument):
+                return frame, type(instance), field.name
+        frame = frame.f_back
+    return None, None, None
+
+
+def _get_call_site(frame):
+    while frame is not None and _is_internal(frame.f_code):
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return '%s:%d in %s' % (frame.f_code.co_filename, frame.f_lineno,
+                            frame.f_code.co_name)
+
+
+def _is_pk_fetch(query):
+    # The pk can be combined with equality matches, e.g. the is_deleted of
+    # NotDeletedQuerySet, and with any _cls match.
+    shape = query['query']
+    return query['op'] == 'query' and bool(shape) and shape.get('_id') == 1 and \
+        all(val == 1 or key == '_cls' for key, val in shape.items())
+
+
+class NPlusOneDetector(inprocess_query_counter):
+    """
+    Context manager which detects N+1 queries in the current thread, see
+    the module docstring. get_report returns the groups of fetches by primary
+    key which passed the threshold.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, raise_errors=False):
+        super(NPlusOneDetector, self).__init__()
+        self.threshold = threshold
+        self.raise_errors = raise_errors
+        self.groups = {}
+
+    def add_query(self, query):
+        super(NPlusOneDetector, self).add_query(query)
+        if not _is_pk_fetch(query) or query['ns'] in self.get_ignored_collections():
+            return
+
+        frame, doc_cls, field_name = _get_dereference(sys._getframe())
+        call_site = _get_call_site(frame or sys._getframe())
+        key = (query['ns'], call_site, doc_cls, field_name)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = self._get_group(*key)
+        group['count'] += 1
+
+        if group['count'] == self.threshold + 1:
+            message = self._get_message(group)
+            if self.raise_errors:
+                raise NPlusOneException(message)
+            logger.warning(message)
+
+    def _get_group(self, ns, call_site, doc_cls, field_name):
+        field_dict = suggestion = None
+        if doc_cls is not None and issubclass(doc_cls, BaseDocument):
+            field_dict = {field_name: True}
+            suggestion = 'fetch_related(objs, %r)' % field_dict
+        elif doc_cls is not None:
+            suggestion = 'fetch_mongo_references(objs, %r)' % [field_name]
+        return {
+            'ns': ns,
+            'call_site': call_site,
+            'document': doc_cls.__name__ if doc_cls else None,
+            'field': field_name,
+            'field_dict': field_dict,
+            'suggestion': suggestion,
+            'count': 0,
+        }
+
+    def _get_message(self, group):
+        if group['field']:
+            source = ' via %s.%s' % (group['document'], group['field'])
+        else:
+            source = ''
+        message = 'N+1 queries: more than %d documents of %s fetched by pk%s at %s.' % (
+            self.threshold, group['ns'], source, group['call_site'])
+        if group['suggestion']:
+            message += ' Fetch them at once with %s.' % group['suggestion']
+        return message
+
+    def get_report(self):
+        """
+        Returns the groups of fetches which passed the threshold, most
+        frequent first. Each group is a dict with the fetched namespace (ns),
+        the call site, the document (or SQL model) and field it was
+        dereferenced from, if any, the fetch_related field_dict (for
+        documents), a suggested fix and the number of fetches.
+        """
+        groups = [group for group in self.groups.values() if group['count'] > self.threshold]
+        return sorted(groups, key=lambda group: -group['count'])
+
+
+def init_nplusone_detection(app):
+    """
+    Registers request hooks which detect N+1 queries in each request of the
+    given app if the NPLUSONE_DETECTION config option is set.
+    """
+    @app.before_request
+    def start_nplusone_detection():
+        config = app.config
+        if config.get('NPLUSONE_DETECTION'):
+            detector = NPlusOneDetector(
+                threshold=config.get('NPLUSONE_THRESHOLD', DEFAULT_THRESHOLD),
+                raise_errors=config.get('NPLUSONE_RAISE', False))
+            detector.__enter__()
+            _request_ctx_stack.top.flask_common_nplusone_detector = detector
+
+    @app.teardown_request
+    def stop_nplusone_detection(exc=None):
+        detector = getattr(_request_ctx_stack.top, 'flask_common_nplusone_detector', None)
+        if detector is not None:
+            detector.__exit__(None, None, None)
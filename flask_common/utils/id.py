@@ -1,11 +1,280 @@
+import binascii
+import calendar
+import datetime
+import os
+import string
+import threading
+import time
 import uuid
 
-from zbase62 import zbase62
+
+ZBASE62_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+# All two-char combinations, so that we can encode two chars per division.
+_ZBASE62_PAIRS = [a + b for a in ZBASE62_CHARS for b in ZBASE62_CHARS]
+
+# Translates chars to their values. Like in zbase62, other chars are left
+# alone, i.e. their value is their ordinal.
+_ZBASE62_VALUES = string.maketrans(ZBASE62_CHARS, ''.join(map(chr, range(62))))
+
+_encoded_lengths = {}
+_decoded_lengths = {}
+
+
+def _zbase62_length(num_bytes):
+    # Same as zbase62.num_chars_that_this_many_octets_encode_to, except for
+    # zero bytes (which zbase62 encodes as '0').
+    length = _encoded_lengths.get(num_bytes)
+    if length is None:
+        length = 0
+        num_values = 256 ** num_bytes
+        while num_values > 0:
+            num_values //= 62
+            length += 1
+        _encoded_lengths[num_bytes] = length
+    return length
+
+
+def zbase62_encode(data):
+    """
+    Table-driven equivalent of zbase62.b2a: returns the base-62 encoding of
+    the given byte string.
+    """
+    length = _zbase62_length(len(data))
+    value = int(binascii.hexlify(data), 16) if data else 0
+    chars = []
+    for _ in xrange(length // 2):
+        value, pair = divmod(value, 3844)
+        chars.append(_ZBASE62_PAIRS[pair])
+    if length % 2:
+        chars.append(ZBASE62_CHARS[value])
+    chars.reverse()
+    return ''.join(chars)
+
+
+def _zbase62_num_bytes(length):
+    # Same as zbase62.num_octets_that_encode_to_this_many_chars
+    num_bytes = _decoded_lengths.get(length)
+    if num_bytes is None:
+        num_bytes = 0
+        num_values = 62 ** length
+        while 256 ** (num_bytes + 1) <= num_values:
+            num_bytes += 1
+        _decoded_lengths[length] = num_bytes
+    return num_bytes
+
+
+def zbase62_decode(chars):
+    """
+    Table-driven equivalent of zbase62.a2b: returns the byte string encoded
+    by the given base-62 string.
+    """
+    num_bytes = _zbase62_num_bytes(len(chars))
+    if not num_bytes:
+        return ''
+    value = 0
+    for char_value in bytearray(chars.translate(_ZBASE62_VALUES)):
+        value = value * 62 + char_value
+    return binascii.unhexlify('%0*x' % (num_bytes * 2, value & ((1 << (num_bytes * 8)) - 1)))
+
+
+class _MemoCache(object):
+    """
+    Bounded cache which keeps (approximately) the most recently used items.
+
+    Items are kept in two generations of up to max_size / 2 items each. Hits
+    in the old generation are moved to the new one, and when the new
+    generation is full, it becomes the old one (dropping the previous old
+    generation). Unlike an exact LRU, this needs no bookkeeping on hits in
+    the new generation and is safe to use from multiple threads.
+    """
+
+    def __init__(self, max_size):
+        self.generation_size = max(1, max_size // 2)
+        self._new = {}
+        self._old = {}
+
+    def get(self, key):
+        value = self._new.get(key)
+        if value is None:
+            value = self._old.get(key)
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        if len(self._new) >= self.generation_size:
+            self._old = self._new
+            self._new = {}
+        self._new[key] = value
+
+    def clear(self):
+        self._new = {}
+        self._old = {}
+
+
+_uuid_cache = _MemoCache(10000)
 
 
 def uuid_to_id(uuid_obj, prefix):
-    return '{}_{}'.format(prefix, zbase62.b2a(uuid_obj.bytes))
+    return '{}_{}'.format(prefix, zbase62_encode(uuid_obj.bytes))
 
 def id_to_uuid(id_str):
-    uuid_bytes = zbase62.a2b(str(id_str[id_str.find('_')+1:]))
-    return uuid.UUID(bytes=uuid_bytes)
+    uuid_obj = _uuid_cache.get(id_str)
+    if uuid_obj is None:
+        uuid_bytes = zbase62_decode(str(id_str[id_str.find('_')+1:]))
+        uuid_obj = uuid.UUID(bytes=uuid_bytes)
+        _uuid_cache.set(id_str, uuid_obj)
+    return uuid_obj
+
+_raise = object()
+
+def ids_to_uuids(id_strs, default=_raise):
+    """
+    Converts a list of IDs to UUIDs. Values which aren't strings (e.g. UUIDs)
+    are kept. Invalid IDs raise a ValueError, unless a default is given, which
+    is then used instead.
+    """
+    uuids = []
+    get, append = _uuid_cache.get, uuids.append
+    for id_str in id_strs:
+        if isinstance(id_str, basestring):
+            uuid_obj = get(id_str)
+            if uuid_obj is None:
+                try:
+                    uuid_obj = id_to_uuid(id_str)
+                except ValueError:
+                    if default is _raise:
+                        raise
+                    uuid_obj = default
+            append(uuid_obj)
+        else:
+            append(id_str)
+    return uuids
+
+def uuids_to_ids(uuid_objs, prefix):
+    """Converts a list of UUIDs to IDs with the given prefix."""
+    prefix = '{}_'.format(prefix)
+    return [prefix + zbase62_encode(uuid_obj.bytes) for uuid_obj in uuid_objs]
+
+
+class IDFactory(object):
+    """
+    Thread-safe factory of random prefixed IDs (<prefix>_<zbase62 encoded
+    random bytes>).
+
+    Instead of reading a few random bytes and encoding them for each ID,
+    entropy is read in blocks of pool_size IDs, which are encoded at once and
+    handed out from a pool per prefix.
+
+    If uuid4 is True, the random bytes are made a valid version 4 UUID (and
+    num_bytes must be 16), i.e. the IDs are the same as
+    uuid_to_id(uuid.uuid4(), prefix).
+    """
+
+    def __init__(self, num_bytes=16, pool_size=256, uuid4=False):
+        if uuid4 and num_bytes != 16:
+            raise ValueError('UUIDs have 16 bytes')
+        self.num_bytes = num_bytes
+        self.pool_size = pool_size
+        self.uuid4 = uuid4
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._pid = os.getpid()
+
+    def _generate(self, prefix):
+        num_bytes = self.num_bytes
+        block = os.urandom(num_bytes * self.pool_size)
+        if self.uuid4:
+            block = bytearray(block)
+            for offset in xrange(0, len(block), num_bytes):
+                # set the version (4) and the variant (RFC 4122)
+                block[offset + 6] = (block[offset + 6] & 0x0f) | 0x40
+                block[offset + 8] = (block[offset + 8] & 0x3f) | 0x80
+            block = str(block)
+        prefix += '_'
+        return [prefix + zbase62_encode(block[offset:offset + num_bytes])
+                for offset in xrange(0, len(block), num_bytes)]
+
+    def get(self, prefix):
+        """Returns a new ID with the given prefix."""
+        with self._lock:
+            # Forked processes must not hand out the IDs that were pooled
+            # in the parent.
+            if self._pid != os.getpid():
+                self._pools = {}
+                self._pid = os.getpid()
+
+            pool = self._pools.get(prefix)
+            if not pool:
+                pool = self._pools[prefix] = self._generate(prefix)
+            return pool.pop()
+
+
+uuid_id_factory = IDFactory(num_bytes=16, uuid4=True)
+
+def generate_id(prefix):
+    """Returns a new random UUID-based ID, like uuid_to_id(uuid.uuid4(), prefix)."""
+    return uuid_id_factory.get(str(prefix))
+
+
+# Time-ordered IDs start with a 48-bit big-endian timestamp in milliseconds
+# (like UUIDv7), so that new IDs sort after older ones and inserts go to the
+# end of the index instead of a random place. Since zbase62 encodes the bytes
+# as a big-endian number with a fixed number of chars, the text IDs of the
+# same length sort the same way.
+
+def _datetime_to_ms(dt):
+    return calendar.timegm(dt.utctimetuple()) * 1000 + dt.microsecond // 1000
+
+def time_ordered_bytes(num_bytes, dt=None):
+    """
+    Returns num_bytes bytes starting with the timestamp of the given datetime
+    (or now) followed by random bytes.
+    """
+    ms = _datetime_to_ms(dt) if dt else int(time.time() * 1000)
+    return binascii.unhexlify('%012x' % ms) + os.urandom(num_bytes - 6)
+
+def time_ordered_uuid(dt=None):
+    """Returns a UUIDv7-style time-ordered UUID."""
+    uuid_bytes = bytearray(time_ordered_bytes(16, dt))
+    # set the version (7) and the variant (RFC 4122)
+    uuid_bytes[6] = (uuid_bytes[6] & 0x0f) | 0x70
+    uuid_bytes[8] = (uuid_bytes[8] & 0x3f) | 0x80
+    return uuid.UUID(bytes=str(uuid_bytes))
+
+def generate_time_ordered_id(prefix, num_bytes=16):
+    """
+    Returns a new time-ordered ID with the given prefix. IDs with 16 bytes
+    are UUIDs (see time_ordered_uuid).
+    """
+    if num_bytes == 16:
+        data = time_ordered_uuid().bytes
+    else:
+        data = time_ordered_bytes(num_bytes)
+    return prefix + '_' + zbase62_encode(data)
+
+def uuid_to_datetime(uuid_obj):
+    """
+    Returns the (naive UTC) datetime embedded in a time-ordered UUID. The
+    result is meaningless for random UUIDs.
+    """
+    ms = int(binascii.hexlify(uuid_obj.bytes[:6]), 16)
+    return datetime.datetime.utcfromtimestamp(ms / 1000.0)
+
+def id_to_datetime(id_str):
+    """
+    Returns the (naive UTC) datetime embedded in a time-ordered ID. The result
+    is meaningless for random IDs.
+    """
+    data = zbase62_decode(str(id_str[id_str.find('_')+1:]))
+    ms = int(binascii.hexlify(data[:6]), 16)
+    return datetime.datetime.utcfromtimestamp(ms / 1000.0)
+
+def datetime_to_id(dt, prefix, num_bytes=16):
+    """
+    Returns the lowest possible time-ordered ID for the given datetime, e.g.
+    to query documents created since then with id__gte.
+    """
+    ms = binascii.unhexlify('%012x' % _datetime_to_ms(dt))
+    return prefix + '_' + zbase62_encode(ms + '\x00' * (num_bytes - 6))
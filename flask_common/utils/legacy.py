@@ -29,6 +29,7 @@ from socket import gethostname
 
 
 from ..enum import Enum # deprecated
+from .objects import get_query_shape
 
 
 def returns_xml(f):
@@ -654,6 +655,342 @@ if mongoengine:
             count = queries.count()
             return count
 
+
+    # Collection methods recorded by inprocess_query_counter, with the name
+    # of their operation and whether they take a query and return a document.
+    _QUERY_COUNTER_COLLECTION_METHODS = {
+        'find_one': ('query', True, True),
+        'count': ('count', True, False),
+        'distinct': ('distinct', False, False),
+        'aggregate': ('aggregate', False, False),
+        'insert': ('insert', False, False),
+        'insert_one': ('insert', False, False),
+        'insert_many': ('insert', False, False),
+        'save': ('insert', False, False),
+        'update': ('update', True, False),
+        'update_one': ('update', True, False),
+        'update_many': ('update', True, False),
+        'replace_one': ('update', True, False),
+        'remove': ('remove', True, False),
+        'delete_one': ('remove', True, False),
+        'delete_many': ('remove', True, False),
+        'find_and_modify': ('findAndModify', True, True),
+        'find_one_and_update': ('findAndModify', True, True),
+        'find_one_and_replace': ('findAndModify', True, True),
+        'find_one_and_delete': ('findAndModify', True, True),
+    }
+
+    class _QueryCounterLocal(threading.local):
+        def __init__(self):
+            self.counters = []  # active counters of the thread
+            self.busy = False  # whether a recorded call is in progress
+
+    _query_counter_local = _QueryCounterLocal()
+    _query_counter_lock = threading.Lock()
+
+    def _get_query_spec(args, kwargs):
+        if args:
+            spec = args[0]
+        else:
+            spec = next((kwargs[key] for key in ('spec', 'filter', 'query', 'spec_or_id')
+                         if key in kwargs), None)
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+        return spec
+
+    def _record_query(ns, op, spec, duration, docs):
+        record = {
+            'ns': ns,
+            'op': op,
+            'query': get_query_shape(spec),
+            'duration': duration,
+            'docs': docs,
+        }
+        for counter in _query_counter_local.counters:
+            counter.add_query(record)
+        return record
+
+    def _call_recorded(func, ns, op, spec, returns_doc, *args, **kwargs):
+        local = _query_counter_local
+        local.busy = True  # don't record nested calls, e.g. find in find_one
+        start = time.time()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            return result
+        finally:
+            local.busy = False
+            _record_query(ns, op, spec, time.time() - start,
+                          int(result is not None) if returns_doc else None)
+
+    def _recording_collection_method(func, op, takes_spec, returns_doc):
+        @wraps(func)
+        def wrapper(collection, *args, **kwargs):
+            local = _query_counter_local
+            if not local.counters or local.busy:
+                return func(collection, *args, **kwargs)
+            spec = _get_query_spec(args, kwargs) if takes_spec else None
+            return _call_recorded(func, collection.full_name, op, spec,
+                                  returns_doc, collection, *args, **kwargs)
+        return wrapper
+
+    def _recording_find(func):
+        # The query is executed (and recorded) by the cursor.
+        @wraps(func)
+        def wrapper(collection, *args, **kwargs):
+            cursor = func(collection, *args, **kwargs)
+            cursor._query_counter_spec = (collection.full_name, _get_query_spec(args, kwargs))
+            return cursor
+        return wrapper
+
+    def _recording_cursor_next(func):
+        @wraps(func)
+        def wrapper(cursor):
+            local = _query_counter_local
+            spec = getattr(cursor, '_query_counter_spec', None)
+            if spec is None or local.busy:
+                return func(cursor)
+            record = getattr(cursor, '_query_counter_record', None)
+            if record is None and not local.counters:
+                return func(cursor)
+
+            local.busy = True
+            start = time.time()
+            doc = None
+            try:
+                doc = func(cursor)
+                return doc
+            finally:
+                local.busy = False
+                duration = time.time() - start
+                if record is None:
+                    ns, spec = spec
+                    cursor._query_counter_record = _record_query(ns, 'query', spec, duration, 0)
+                else:
+                    record['duration'] += duration
+                if doc is not None:
+                    cursor._query_counter_record['docs'] += 1
+        return wrapper
+
+    def _recording_cursor_method(func, op):
+        @wraps(func)
+        def wrapper(cursor, *args, **kwargs):
+            local = _query_counter_local
+            spec = getattr(cursor, '_query_counter_spec', None)
+            if spec is None or not local.counters or local.busy:
+                return func(cursor, *args, **kwargs)
+            ns, spec = spec
+            return _call_recorded(func, ns, op, spec, False, cursor, *args, **kwargs)
+        return wrapper
+
+    def _recording_cursor_getitem(func):
+        # cursor[index] queries a single document (cursor[slice] doesn't query)
+        @wraps(func)
+        def wrapper(cursor, index):
+            local = _query_counter_local
+            spec = getattr(cursor, '_query_counter_spec', None)
+            if isinstance(index, slice) or spec is None or \
+                    not local.counters or local.busy:
+                return func(cursor, index)
+            ns, spec = spec
+            return _call_recorded(func, ns, 'query', spec, True, cursor, index)
+        return wrapper
+
+    def _recording_cursor_clone(func):
+        @wraps(func)
+        def wrapper(cursor, *args, **kwargs):
+            clone = func(cursor, *args, **kwargs)
+            clone._query_counter_spec = getattr(cursor, '_query_counter_spec', None)
+            return clone
+        return wrapper
+
+    # order in which unordered bulk writes send their batches
+    _QUERY_COUNTER_BULK_OPS = ('insert', 'update', 'remove')
+
+    def _get_bulk_batches(ops, ordered):
+        # Groups the (op, spec) pairs of a bulk write into the batches it's
+        # sent in: by operation, and only consecutive ones if it's ordered.
+        # The spec of the first operation of a batch is used for the batch.
+        batches = []
+        for op, spec in ops:
+            if ordered:
+                if not batches or batches[-1][0] != op:
+                    batches.append((op, spec))
+            elif op not in [batch_op for batch_op, batch_spec in batches]:
+                batches.append((op, spec))
+        if not ordered:
+            batches.sort(key=lambda batch: _QUERY_COUNTER_BULK_OPS.index(batch[0]))
+        return batches
+
+    def _get_pymongo_bulk_ops(bulk):
+        # pymongo.bulk._Bulk keeps (op type, document or command) pairs
+        from pymongo.bulk import _INSERT, _UPDATE, _DELETE
+        op_names = {_INSERT: 'insert', _UPDATE: 'update', _DELETE: 'remove'}
+        ops = [(op_names[op_type], None if op_type == _INSERT else operation['q'])
+               for op_type, operation in bulk.ops]
+        return bulk.collection.full_name, bulk.ordered, ops
+
+    def _get_mongomock_bulk_ops(builder):
+        # mongomock's BulkOperationBuilder keeps closures named after the
+        # operations (exec_insert etc.), which reference their selector
+        ops = []
+        for executor in builder.executors:
+            cells = dict(zip(executor.__code__.co_freevars,
+                             [cell.cell_contents for cell in executor.__closure__ or ()]))
+            ops.append((executor.__name__[len('exec_'):], cells.get('selector')))
+        return builder.collection.full_name, builder.ordered, ops
+
+    def _recording_bulk_execute(func, get_ops):
+        # Bulk writes don't go through the collection methods. They're
+        # recorded once per batch, i.e. per command sent to the server.
+        @wraps(func)
+        def wrapper(bulk, *args, **kwargs):
+            local = _query_counter_local
+            if not local.counters or local.busy:
+                return func(bulk, *args, **kwargs)
+            ns, ordered, ops = get_ops(bulk)
+            batches = _get_bulk_batches(ops, ordered)
+            local.busy = True
+            start = time.time()
+            try:
+                return func(bulk, *args, **kwargs)
+            finally:
+                local.busy = False
+                duration = (time.time() - start) / max(len(batches), 1)
+                for op, spec in batches:
+                    _record_query(ns, op, spec, duration, None)
+        return wrapper
+
+    def _install_query_counter_hooks():
+        """
+        Wraps the methods of pymongo's (and mongomock's, if installed)
+        collections and cursors that talk to the database, so that
+        inprocess_query_counter can record them. This is done once, on first
+        use of the counter. When no counter is active in the current thread,
+        the wrappers call the original methods right away.
+        """
+        with _query_counter_lock:
+            if getattr(_install_query_counter_hooks, 'installed', False):
+                return
+
+            classes = []
+            import pymongo.bulk
+            import pymongo.collection
+            import pymongo.cursor
+            classes.append((pymongo.collection.Collection, pymongo.cursor.Cursor))
+            pymongo.bulk._Bulk.execute = _recording_bulk_execute(
+                pymongo.bulk._Bulk.__dict__['execute'], _get_pymongo_bulk_ops)
+            try:
+                import mongomock.collection
+                classes.append((mongomock.collection.Collection, mongomock.collection.Cursor))
+                builder_cls = mongomock.collection.BulkOperationBuilder
+                builder_cls.execute = _recording_bulk_execute(
+                    builder_cls.__dict__['execute'], _get_mongomock_bulk_ops)
+            except ImportError:
+                pass
+
+            for collection_cls, cursor_cls in classes:
+                for name, (op, takes_spec, returns_doc) in _QUERY_COUNTER_COLLECTION_METHODS.items():
+                    if name in collection_cls.__dict__:
+                        setattr(collection_cls, name, _recording_collection_method(
+                            collection_cls.__dict__[name], op, takes_spec, returns_doc))
+                collection_cls.find = _recording_find(collection_cls.__dict__['find'])
+                cursor_cls.next = _recording_cursor_next(cursor_cls.__dict__['next'])
+                cursor_cls.__getitem__ = _recording_cursor_getitem(cursor_cls.__dict__['__getitem__'])
+                for name in ('count', 'distinct'):
+                    if name in cursor_cls.__dict__:
+                        setattr(cursor_cls, name, _recording_cursor_method(cursor_cls.__dict__[name], name))
+                for name in ('_clone', 'clone'):
+                    if name in cursor_cls.__dict__:
+                        setattr(cursor_cls, name, _recording_cursor_clone(cursor_cls.__dict__[name]))
+
+            _install_query_counter_hooks.installed = True
+
+    class inprocess_query_counter(object):
+        """
+        Alternative to custom_query_counter which doesn't use the
+        system.profile collection (and hence doesn't need profiling, doesn't
+        count queries of other connections and works with mongomock).
+
+        It records the database operations executed by pymongo in the current
+        thread (bulk writes once per batch of an operation): their namespace
+        (ns), operation (op), query shape (query),
+        duration and the number of documents returned (docs, None for
+        operations that don't return documents). The records are kept in the
+        queries list. Counters can be nested, in which case the outer counter
+        also records the operations within the inner one.
+
+        Like with custom_query_counter, extend get_ignored_collections to
+        ignore some of the collections and initialize with
+        inprocess_query_counter(verbose=True) for debugging.
+        """
+
+        def __init__(self, verbose=False):
+            self.db = mongoengine.connection.get_db()
+            self.verbose = verbose
+            self.queries = []
+
+        def __enter__(self):
+            _install_query_counter_hooks()
+            _query_counter_local.counters.append(self)
+            return self
+
+        def __exit__(self, t, value, traceback):
+            _query_counter_local.counters.remove(self)
+
+        def add_query(self, query):
+            """ Called with the record of each operation. """
+            self.queries.append(query)
+
+        def get_ignored_collections(self):
+            return [
+                "{0}.system.indexes".format(self.db.name),
+                "{0}.system.namespaces".format(self.db.name),
+                "{0}.system.profile".format(self.db.name),
+                "{0}.$cmd".format(self.db.name),
+            ]
+
+        def _get_queries(self):
+            ignored = self.get_ignored_collections()
+            return [query for query in self.queries if query['ns'] not in ignored]
+
+        def _get_count(self):
+            """ Get the number of queries. """
+            queries = self._get_queries()
+            if self.verbose:
+                print('-'*80)
+                for query in queries:
+                    print('{} [{}] {} ({:.2f} ms, {} docs)'.format(
+                        query['ns'], query['op'], query['query'],
+                        query['duration'] * 1000, query['docs']))
+                    print()
+                print('-'*80)
+            return len(queries)
+
+        def __eq__(self, value):
+            return value == self._get_count()
+
+        def __ne__(self, value):
+            return not self.__eq__(value)
+
+        def __lt__(self, value):
+            return self._get_count() < value
+
+        def __le__(self, value):
+            return self._get_count() <= value
+
+        def __gt__(self, value):
+            return self._get_count() > value
+
+        def __ge__(self, value):
+            return self._get_count() >= value
+
+        def __int__(self):
+            return self._get_count()
+
+        def __repr__(self):
+            return repr(self._get_count())
+
 def truncate(text, size):
     """
     Truncates the given text to the given size. If we are in the middle of
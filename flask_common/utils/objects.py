@@ -11,6 +11,27 @@ def freeze(x):
     return x
 
 
+def get_query_shape(query):
+    """
+    Convert a query into a query shape, e.g.:
+    * { _cls: 'whatever' } into { _cls: 1 }
+    * { date: { $gte: '2015-01-01', $lte: '2015-01-31' } into { date: { $gte: 1, $lte: 1 } }
+    * { _cls: { $in: [ 'a', 'b', 'c' ] } } into { _cls: { $in: [] } }
+    """
+    if not query:
+        return query
+
+    query_shape = {}
+    for key, val in query.items():
+        if isinstance(val, dict):
+            query_shape[key] = get_query_shape(val)
+        elif isinstance(val, (list, tuple)):
+            query_shape[key] = []
+        else:
+            query_shape[key] = 1
+    return query_shape
+
+
 def dict_with_class(obj):
     """Just like obj.__dict__, but includes data (non-function) class attributes."""
     d = {}
@@ -1,34 +1,64 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import os
 import random
 import string
+import tempfile
+import threading
 import time
 import unittest
 
+from bson import ObjectId
 from dateutil.tz import tzutc
 from flask import Flask
-from mongoengine import connection, Document
-from mongoengine.errors import DoesNotExist
+from mongoengine import connection, Document, EmbeddedDocument
+from mongoengine.errors import DoesNotExist, NotUniqueError, OperationError
 from mongoengine.fields import (ReferenceField, SafeReferenceField,
                                 SafeReferenceListField, StringField,
-                                IntField)
+                                IntField, ListField, EmbeddedDocumentField,
+                                GenericReferenceField)
 import pytz
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
 from werkzeug.datastructures import MultiDict
 from wtforms import Form
+from zbase62 import zbase62
 
 from flask_mongoengine import MongoEngine, ValidationError
 from flask_common.crypto import aes_generate_key
+from flask_common.db import Base, MongoReference, fetch_mongo_references
 from flask_common.declenum import DeclEnum
-from flask_common.documents import fetch_related, iter_no_cache
+from flask_common.documents import (compile_fetch_plan, fetch_related,
+                                    AdaptiveBatchSizer, ForbiddenQueriesQuerySet,
+                                    ForbiddenQueryException, QueryStats,
+                                    TelemetryQuerySet,
+                                    iter_no_cache, iter_partitioned,
+                                    map_partitions, partition_queryset,
+                                    iter_checkpointed, FileCheckpointStore)
 from flask_common.utils import (apply_recursively, slugify,
-                                custom_query_counter, uniqify)
+                                custom_query_counter, inprocess_query_counter,
+                                uniqify)
 from flask_common.fields import (PhoneField, TimezoneField, TrimmedStringField,
                                 EncryptedStringField, LowerStringField,
-                                LowerEmailField)
+                                LowerEmailField, IDField)
 from flask_common.formfields import BetterDateTimeField
+from flask_common.identity_map import IdentityMap, get_identity_map
+from flask_common.index_advisor import (CollectionScanException, IndexAdvisor,
+                                       StrictIndexQuerySet)
+from flask_common.loader import ReferenceLoader, get_reference_loader
+from flask_common.nplusone import (NPlusOneDetector, NPlusOneException,
+                                   init_nplusone_detection)
+from flask_common.utils.id import (IDFactory, datetime_to_id, generate_id,
+                                  generate_time_ordered_id, id_to_datetime,
+                                  id_to_uuid, ids_to_uuids, uuid_to_datetime,
+                                  uuid_to_id, uuids_to_ids, zbase62_decode,
+                                  zbase62_encode)
 from flask_common.documents import (RandomPKDocument, DocumentBase,
-                                    SoftDeleteDocument)
+                                    IdentityMapQuerySet,
+                                    SoftDeleteDocument, archive_deleted,
+                                    get_archive_collection,
+                                    partial_index_report)
 
 
 
@@ -152,6 +182,94 @@ class DocTestCase(unittest.TestCase):
         self.assertEqual(doc.date_created.replace(tzinfo=None), new_date_created)
         self.assertEqual(doc.date_updated.replace(tzinfo=None), new_date_updated)
 
+    def test_bulk_insert(self):
+        class Doc(DocumentBase, RandomPKDocument):
+            text = StringField(required=True)
+
+        Doc.drop_collection()
+        existing = Doc.objects.create(text='existing')
+
+        # the first generated ID collides with an existing document
+        pks = [existing.pk]
+        generate_pk = Doc.generate_pk
+        Doc.generate_pk = classmethod(lambda cls: pks.pop() if pks else generate_pk())
+
+        try:
+            docs = [Doc(text='a'), Doc(text='b'), Doc(), Doc(pk=existing.pk, text='c')]
+            inserted, errors = Doc.bulk_insert(docs, batch_size=2)
+        finally:
+            Doc.generate_pk = generate_pk
+
+        self.assertEqual([doc.text for doc in inserted], ['a', 'b'])
+        self.assertEqual(set(errors), set([2, 3]))
+        self.assertTrue(isinstance(errors[2], ValidationError))
+        self.assertTrue(isinstance(errors[3], OperationError))
+
+        self.assertNotEqual(docs[0].pk, existing.pk)
+        self.assertTrue(inserted[0] is docs[0] and inserted[1] is docs[1])
+        self.assertEqual(docs[2].pk, None)
+
+        self.assertFalse(docs[0]._created)
+        self.assertFalse(docs[0]._changed_fields)
+
+        self.assertEqual(Doc.objects.count(), 3)
+        doc = Doc.objects.get(pk=docs[1].pk)
+        self.assertEqual(doc.text, 'b')
+        self.assertTrue(doc.date_created)
+        self.assertEqual(doc.date_created, doc.date_updated)
+
+    def test_bulk_update(self):
+        class Doc(DocumentBase, RandomPKDocument, SoftDeleteDocument):
+            text = StringField()
+            num = IntField(default=0)
+
+        Doc.drop_collection()
+        a = Doc.objects.create(text='a')
+        b = Doc.objects.create(text='b')
+        c = Doc.objects.create(text='c')
+        date_updated = c.reload().date_updated
+
+        time.sleep(0.001)  # make sure some time passes between the updates
+        result = Doc.bulk_update([
+            (a, {'set__text': 'A', 'inc__num': 2}),
+            (b.pk, {'text': 'B'}),
+            (c, {'inc__num': 1, 'update_date': False}),
+            ('doc_doesnotexist', {'set__text': 'D'}),
+        ], batch_size=3)
+        self.assertEqual([batch['matched'] for batch in result], [3, 0])
+
+        a.reload()
+        self.assertEqual((a.text, a.num), ('A', 2))
+        self.assertTrue(a.date_updated > a.date_created)
+        self.assertEqual(b.reload().text, 'B')
+        c.reload()
+        self.assertEqual(c.num, 1)
+        self.assertEqual(c.date_updated, date_updated)
+
+        self.assertRaises(ValidationError, Doc.bulk_update,
+                          [(a, {'set__text': 'x'}), (b, {'set__is_deleted': None})])
+        self.assertEqual(a.reload().text, 'A')
+
+    def test_bulk_update_caches(self):
+        class Doc(DocumentBase):
+            id = IDField(prefix='doc', autogenerate=True, primary_key=True)
+            text = StringField()
+
+            meta = {'queryset_class': IdentityMapQuerySet}
+
+        Doc.drop_collection()
+        doc = Doc.objects.create(text='a')
+
+        cache_app = Flask('caches')
+        cache_app.config.update(IDENTITY_MAP_ENABLED=True, REFERENCE_LOADER_ENABLED=True)
+        with cache_app.app_context():
+            self.assertEqual(Doc.objects.get(pk=doc.pk).text, 'a')
+            self.assertEqual(get_reference_loader().load(Doc, doc.pk).text, 'a')
+
+            Doc.bulk_update([(doc.pk, {'set__text': 'A'})])
+            self.assertEqual(Doc.objects.get(pk=doc.pk).text, 'A')
+            self.assertEqual(get_reference_loader().load(Doc, doc.pk).text, 'A')
+
 
 class SoftDeleteTestCase(unittest.TestCase):
     class Person(DocumentBase, RandomPKDocument, SoftDeleteDocument):
@@ -226,6 +344,238 @@ class SoftDeleteTestCase(unittest.TestCase):
         self.assertTrue(a.date_updated > last_date_updated)
         self.assertEqual(a.is_deleted, True)
 
+    def test_queryset_soft_delete(self):
+        a = self.Person.objects.create(name='Anthony')
+        b = self.Person.objects.create(name='Bob')
+        c = self.Programmer.objects.create(name='Thomas', language='python.net')
+        last_date_updated = a.reload().date_updated
+
+        time.sleep(0.001)  # make sure some time passes between the updates
+        self.assertEqual(self.Person.objects.filter(name__in=['Anthony', 'Thomas']).soft_delete(), 2)
+        self.assertEqual(self.Person.objects.count(), 1)
+        self.assertEqual(self.Person.all_objects.count(), 3)
+
+        a.reload()
+        self.assertTrue(a.is_deleted)
+        self.assertTrue(a.date_updated > last_date_updated)
+        self.assertFalse(b.reload().is_deleted)
+        self.assertTrue(c.reload().is_deleted)
+
+        # objects never matches deleted documents
+        self.assertEqual(self.Person.objects.restore(), 0)
+
+        self.assertEqual(self.Person.all_objects.filter(name='Anthony').restore(), 1)
+        self.assertEqual(self.Person.all_objects.restore(), 1)
+        self.assertEqual(self.Person.objects.count(), 3)
+        self.assertEqual(self.Person.all_objects.soft_delete(), 3)
+        self.assertEqual(self.Person.objects.count(), 0)
+
+    def test_cached_count(self):
+        for name in ['Anthony', 'Bob', 'Bob']:
+            self.Person.objects.create(name=name)
+
+        self.assertEqual(self.Person.objects.cached_count(), 3)
+        self.assertEqual(self.Person.objects.filter(name='Bob').cached_count(), 2)
+
+        # writes that bypass the documents aren't picked up until the TTL expires
+        self.assertEqual(self.Person.objects.filter(name='Anthony').cached_count(ttl=0), 1)
+        self.Person._get_collection().insert({'_id': 'person_raw1', '_cls': 'Person', 'name': 'Bob',
+                                              'is_deleted': False})
+        self.Person._get_collection().insert({'_id': 'person_raw2', '_cls': 'Person', 'name': 'Anthony',
+                                              'is_deleted': False})
+        self.assertEqual(self.Person.objects.filter(name='Bob').cached_count(), 2)
+        self.assertEqual(self.Person.objects.filter(name='Anthony').cached_count(), 2)
+
+        # writes through the documents invalidate the cached counts
+        self.Person.objects.create(name='Bob')
+        self.assertEqual(self.Person.objects.cached_count(), 6)
+        self.Person.objects.get(name='Bob', pk='person_raw1').delete()
+        self.assertEqual(self.Person.objects.cached_count(), 5)
+        self.assertEqual(self.Person.all_objects.cached_count(), 6)
+
+    def test_estimated_count(self):
+        for i in range(40):
+            person = self.Person.objects.create(name=str(i))
+            if i % 4 == 0:
+                person.delete()
+
+        self.assertEqual(self.Person.all_objects.estimated_count(), 40)
+        self.assertEqual(self.Person.objects.estimated_count(), 30)
+
+        # 29 or 30 of the 39 sampled documents aren't deleted
+        self.assertTrue(self.Person.objects.estimated_count(sample_size=39) in (30, 31))
+
+    def test_archive_deleted(self):
+        archive_collection = get_archive_collection(self.Person)
+        archive_collection.drop()
+
+        people = [self.Person.objects.create(name=name)
+                  for name in ['Anthony', 'Bob', 'Chris', 'Dave', 'Eve']]
+        self.Person.objects.filter(name__in=['Anthony', 'Bob', 'Chris', 'Dave']).soft_delete()
+        self.Person.all_objects.filter(name='Dave').update(
+            set__date_updated=datetime.datetime.utcnow() + datetime.timedelta(days=1))
+
+        self.assertEqual(archive_deleted(self.Person, datetime.datetime.utcnow(), batch_size=2), 3)
+        self.assertEqual(archive_deleted(self.Person, datetime.datetime.utcnow()), 0)
+
+        self.assertEqual(set(p.name for p in self.Person.all_objects), set(['Dave', 'Eve']))
+        self.assertEqual(archive_collection.count(), 3)
+        self.assertEqual(set(p.name for p in self.Person.all_objects.archived()),
+                         set(['Anthony', 'Bob', 'Chris']))
+        self.assertEqual(self.Person.all_objects.filter(name='Bob').archived().get(), people[1])
+        self.assertEqual(len(list(self.Person.all_objects.iter_with_archive())), 5)
+
+    def test_partial_indexes(self):
+        class Account(SoftDeleteDocument):
+            email = StringField()
+            name = StringField()
+
+            meta = {
+                'indexes': [
+                    'name',
+                    {'fields': ['email'], 'unique': True, 'exclude_deleted': True},
+                ]
+            }
+
+        Account.drop_collection()
+        Account.ensure_indexes()
+
+        indexes = Account._get_collection().index_information()
+        self.assertEqual(indexes['email_1']['partialFilterExpression'], {'is_deleted': False})
+        self.assertFalse('partialFilterExpression' in indexes['name_1'])
+
+        # the unique constraint doesn't apply to deleted documents
+        Account.objects.create(email='a@example.com', name='A').delete()
+        Account.objects.create(email='a@example.com', name='A')
+        self.assertRaises(NotUniqueError, Account.objects.create, email='a@example.com')
+
+        for i in range(8):
+            Account.objects.create(name='deleted').delete()
+
+        report = partial_index_report(Account)
+        self.assertEqual([item['name'] for item in report], ['name_1'])
+        self.assertTrue(report[0]['savings'] > 0)
+        self.assertTrue(report[0]['estimated_size'] < report[0]['size'])
+
+
+class IdentityMapTestCase(unittest.TestCase):
+    class Member(DocumentBase, RandomPKDocument, SoftDeleteDocument):
+        name = StringField()
+
+    def setUp(self):
+        self.Member.drop_collection()
+        app.config['IDENTITY_MAP_ENABLED'] = True
+
+    def tearDown(self):
+        app.config['IDENTITY_MAP_ENABLED'] = False
+
+    def test_lru_eviction(self):
+        people = [self.Member.objects.create(name=str(i)) for i in range(3)]
+        identity_map = IdentityMap(max_size=2)
+        for person in people:
+            identity_map.add(person)
+
+        self.assertEqual(len(identity_map), 2)
+        self.assertEqual(identity_map.get(self.Member, people[0].pk), None)
+        self.assertTrue(identity_map.get(self.Member, people[2].pk) is people[2])
+        self.assertEqual((identity_map.hits, identity_map.misses), (1, 1))
+
+    def test_get(self):
+        person = self.Member.objects.create(name='Steve')
+
+        with app.app_context():
+            with custom_query_counter() as q:
+                p1 = self.Member.objects.get(pk=person.pk)
+                p2 = self.Member.objects.get(pk=person.pk)
+                self.assertTrue(p1 is p2)
+                self.assertEqual(q, 1)
+
+            identity_map = get_identity_map()
+            self.assertEqual((identity_map.hits, identity_map.misses), (1, 1))
+
+        # the identity map is bound to the app context
+        with app.app_context():
+            self.assertEqual(len(get_identity_map()), 0)
+
+        # and it's disabled outside of it
+        self.assertEqual(get_identity_map(), None)
+
+    def test_raw_results(self):
+        person = self.Member.objects.create(name='Steve')
+
+        with app.app_context():
+            # raw results aren't added to the identity map
+            raw = self.Member.objects.as_pymongo().get(pk=person.pk)
+            self.assertTrue(isinstance(raw, dict))
+            self.assertEqual(len(get_identity_map()), 0)
+
+            # nor returned from it
+            self.Member.objects.get(pk=person.pk)
+            raw = self.Member.objects.as_pymongo().get(pk=person.pk)
+            self.assertTrue(isinstance(raw, dict))
+            self.assertEqual(self.Member.objects.scalar('name').get(pk=person.pk), 'Steve')
+
+    def test_invalidation(self):
+        person = self.Member.objects.create(name='Steve')
+
+        with app.app_context():
+            p1 = self.Member.objects.get(pk=person.pk)
+            p1.update(set__name='Tony')
+
+            p2 = self.Member.objects.get(pk=person.pk)
+            self.assertFalse(p1 is p2)
+            self.assertEqual(p2.name, 'Tony')
+
+            p2.delete()
+            self.assertRaises(DoesNotExist, self.Member.objects.get, pk=person.pk)
+
+    def test_queryset_writes(self):
+        person = self.Member.objects.create(name='Steve')
+
+        with app.app_context():
+            self.Member.objects.get(pk=person.pk)
+            self.Member.objects.filter(pk=person.pk).update(set__name='Tony')
+            self.assertEqual(self.Member.objects.get(pk=person.pk).name, 'Tony')
+
+            self.Member.objects.filter(pk=person.pk).update_one(set__name='Bob')
+            self.assertEqual(self.Member.objects.get(pk=person.pk).name, 'Bob')
+
+            self.Member.objects.filter(pk=person.pk).modify(set__name='Joe')
+            self.assertEqual(self.Member.objects.get(pk=person.pk).name, 'Joe')
+
+            self.Member.objects.filter(pk=person.pk).delete()
+            self.assertRaises(DoesNotExist, self.Member.objects.get, pk=person.pk)
+
+    def test_hard_delete(self):
+        class Note(DocumentBase):
+            text = StringField()
+
+            meta = {'queryset_class': IdentityMapQuerySet}
+
+        Note.drop_collection()
+        note = Note.objects.create(text='Hello')
+
+        with app.app_context():
+            Note.objects.get(pk=note.pk).delete()
+            self.assertRaises(DoesNotExist, Note.objects.get, pk=note.pk)
+
+    def test_fetch_related(self):
+        class Post(db.Document):
+            author = ReferenceField(self.Member)
+
+        Post.drop_collection()
+        person = self.Member.objects.create(name='Steve')
+        Post.objects.create(author=person)
+
+        with app.app_context():
+            with custom_query_counter() as q:
+                posts = list(Post.objects.all())
+                fetch_related(posts, {'author': True})
+                self.assertTrue(self.Member.objects.get(pk=person.pk) is posts[0].author)
+
+                # one query for Post, one for Member
+                self.assertEqual(q, 2)
+
 
 class FieldTestCase(unittest.TestCase):
     def setUp(self):
@@ -606,6 +956,125 @@ class FetchRelatedTestCase(unittest.TestCase):
             # one query for D, one query for C, one query for A
             self.assertEqual(q, 3)
 
+    def test_fetch_related_merges_levels(self):
+        """
+        Make sure references to the same document class at the same nesting
+        level are fetched in one query, even if they come from different
+        parent fields.
+        """
+        class G(db.Document):
+            ref_b = ReferenceField(self.B)
+            ref_c = ReferenceField(self.C)
+
+        G.drop_collection()
+        G.objects.create(ref_b=self.b1, ref_c=self.c1)
+
+        with custom_query_counter() as q:
+            objs = list(G.objects.all())
+            fetch_related(objs, {
+                'ref_b': {
+                    'ref': True
+                },
+                'ref_c': {
+                    'ref_a': True
+                }
+            })
+
+            self.assertEqual(objs[0].ref_b.ref.txt, 'a1')
+            self.assertEqual(objs[0].ref_c.ref_a.txt, 'a3')
+
+            # one query for G, one for B, one for C and one for A
+            self.assertEqual(q, 4)
+
+    def test_compile_fetch_plan(self):
+        """
+        Make sure field_dicts are compiled into level-by-level plans that
+        are reused for equal field_dicts.
+        """
+        plan = compile_fetch_plan({
+            'ref_a': True,
+            'ref_c': {
+                'ref_a': ['id']
+            }
+        })
+        self.assertEqual(len(plan.levels), 2)
+        self.assertEqual(
+            set(node.field_name for node in plan.levels[0]),
+            set(['ref_a', 'ref_c'])
+        )
+        self.assertEqual(plan.levels[1][0].fields_to_fetch, ['id'])
+        self.assertTrue(plan is compile_fetch_plan({
+            'ref_c': {
+                'ref_a': ['id']
+            },
+            'ref_a': True
+        }))
+
+        with custom_query_counter() as q:
+            objs = list(self.D.objects.all())
+            fetch_related(objs, plan)
+            self.assertEqual(objs[0].ref_a.txt, 'a3')
+            self.assertEqual(objs[0].ref_c.ref_a.pk, self.a3.pk)
+
+            # one query for D, one for A and one for C
+            self.assertEqual(q, 3)
+
+    def test_fetch_related_chunked(self):
+        """
+        Make sure related objects can be fetched in chunks, concurrently.
+        """
+        cache_map = {}
+        with custom_query_counter() as q:
+            objs = list(self.B.objects.all())
+            fetch_related(objs, compile_fetch_plan({
+                'ref': True
+            }, chunk_size=1, max_workers=2), cache_map=cache_map)
+
+            for obj in objs:
+                self.assertTrue(obj.ref.txt in ('a1', 'a2'))
+
+            # one query for B, one query for each A
+            self.assertEqual(q, 3)
+
+        self.assertEqual(set(cache_map[self.A]), set([self.a1.pk, self.a2.pk]))
+
+    def test_fetch_related_paths_lists_and_generic_refs(self):
+        """
+        Make sure references in embedded documents, plain lists of references
+        and generic references are fetched with one query per document class.
+        """
+        class Address(EmbeddedDocument):
+            owner = ReferenceField(self.A)
+
+        class H(db.Document):
+            addresses = ListField(EmbeddedDocumentField(Address))
+            refs_a = ListField(ReferenceField(self.A))
+            generic = GenericReferenceField()
+
+        H.drop_collection()
+        H.objects.create(
+            addresses=[Address(owner=self.a1), Address(owner=self.a2)],
+            refs_a=[self.a2, self.a3],
+            generic=self.b1
+        )
+
+        with custom_query_counter() as q:
+            objs = list(H.objects.all())
+            fetch_related(objs, {
+                'addresses.owner': True,
+                'refs_a': True,
+                'generic': {
+                    'ref': True
+                }
+            })
+
+            self.assertEqual([a.owner.txt for a in objs[0].addresses], ['a1', 'a2'])
+            self.assertEqual([a.txt for a in objs[0].refs_a], ['a2', 'a3'])
+            self.assertEqual(objs[0].generic.ref.txt, 'a1')
+
+            # one query for H, one for A and one for B (b1.ref is already cached)
+            self.assertEqual(q, 3)
+
     def test_fetch_related_subdict_broken_reference(self):
         """
         Make sure that fetching sub-references of a broken reference works.
@@ -623,6 +1092,39 @@ class FetchRelatedTestCase(unittest.TestCase):
         self.assertTrue(objs[0].ref_c.pk)  # pk still exists even though the reference is broken
         self.assertRaises(DoesNotExist, lambda: objs[0].ref_c.ref_a)
 
+    def test_fetch_related_broken_references_cache(self):
+        """
+        Make sure IDs of objects that don't exist are cached as tombstones
+        (and not fetched again) and that broken references are reported.
+        """
+        self.a1.delete()
+        self.b1.delete()
+
+        cache_map = {}
+        objs = list(self.E.objects.all())
+        with custom_query_counter() as q:
+            broken = fetch_related(objs, {
+                'refs_a': True,
+                'ref_b': True
+            }, cache_map=cache_map)
+            self.assertEqual(q, 2)
+
+        self.assertEqual(broken, {'refs_a': 1, 'ref_b': 1})
+        self.assertEqual(cache_map[self.A][self.a1.pk], None)
+        self.assertEqual(cache_map[self.B], {self.b1.pk: None})
+        self.assertEqual([a.txt for a in objs[0].refs_a], ['a2', 'a3'])
+        self.assertEqual(objs[0].ref_b, None)
+
+        objs = list(self.E.objects.all())
+        with custom_query_counter() as q:
+            broken = fetch_related(objs, {
+                'refs_a': True,
+                'ref_b': True
+            }, cache_map=cache_map)
+            self.assertEqual(q, 0)
+
+        self.assertEqual(broken, {'refs_a': 1, 'ref_b': 1})
+
     def test_partial_fetch_related(self):
         """
         Make sure we can only fetch particular fields of a reference.
@@ -639,15 +1141,56 @@ class FetchRelatedTestCase(unittest.TestCase):
 
     def test_partial_fetch_fields_conflict(self):
         """
-        Fetching certain fields via fetch_related has a limitation that
-        different fields cannot be fetched for the same document class.
-        Make sure that contraint is respected.
+        Make sure that if the same document class is requested with different
+        fields_to_fetch and one of the fields asks for the whole document,
+        whole documents are fetched in a single query.
         """
         objs = list(self.B.objects.all()) + list(self.C.objects.all())
-        self.assertRaises(RuntimeError, fetch_related, objs, {
-            'ref': ["id"],
-            'ref_a': True
-        })
+        cache_map = {}
+        with custom_query_counter() as q:
+            fetch_related(objs, {
+                'ref': ["id"],
+                'ref_a': True
+            }, cache_map=cache_map)
+            self.assertEqual(q, 1)
+
+        self.assertEqual(
+            set([obj.ref.txt for obj in objs if isinstance(obj, self.B)]),
+            set(['a1', 'a2'])
+        )
+        self.assertEqual(objs[-1].ref_a.txt, 'a3')
+
+        # whole documents were fetched, so they're cached
+        self.assertEqual(set(cache_map[self.A]), set([self.a1.pk, self.a2.pk, self.a3.pk]))
+
+    def test_partial_fetch_fields_union(self):
+        """
+        Make sure that if the same document class is requested with different
+        fields_to_fetch, a union of the fields is fetched in a single query.
+        """
+        objs = list(self.B.objects.all()) + list(self.C.objects.all())
+        cache_map = {}
+        with custom_query_counter() as q:
+            fetch_related(objs, {
+                'ref': ["id"],
+                'ref_a': ["txt"]
+            }, cache_map=cache_map)
+            self.assertEqual(q, 1)
+
+            queries = list(q.db.system.profile.find({ 'op': 'query' }, { 'execStats': 1 }))
+            self.assertEqual(
+                set(queries[0]['execStats']['transformBy'].keys()),
+                set(['_id', 'txt'])
+            )
+
+        self.assertEqual(
+            set([obj.ref.pk for obj in objs if isinstance(obj, self.B)]),
+            set([self.a1.pk, self.a2.pk])
+        )
+        self.assertEqual(objs[-1].ref_a.txt, 'a3')
+
+        # partially fetched documents aren't cached
+        self.assertEqual(cache_map, { self.A: {} })
 
     def test_partial_fetch_cache_map(self):
         """
@@ -753,6 +1296,43 @@ class FetchRelatedTestCase(unittest.TestCase):
             )
 
 
+class MongoReferenceTestCase(unittest.TestCase):
+    def setUp(self):
+        Model = declarative_base(cls=Base)
+
+        class Row(Model):
+            __tablename__ = 'row'
+            book_id = sa.Column(sa.String)
+            book = MongoReference('book_id', Book)
+
+        Book.drop_collection()
+        self.Row = Row
+
+    def test_fetch_mongo_references(self):
+        b1 = Book.objects.create()
+        b2 = Book.objects.create()
+        rows = [self.Row(book=b1), self.Row(book=b2), self.Row(book=b1),
+                self.Row(book_id=None)]
+
+        cache_map = {}
+        with custom_query_counter() as q:
+            fetch_mongo_references(rows, ['book'], cache_map=cache_map)
+            self.assertEqual([row.book for row in rows[:3]], [b1, b2, b1])
+            self.assertEqual(q, 1)
+
+        self.assertEqual(set(cache_map[Book]), set([b1.pk, b2.pk]))
+
+    def test_assignment_clears_cache(self):
+        b1 = Book.objects.create()
+        b2 = Book.objects.create()
+        row = self.Row(book=b1)
+        self.assertEqual(row.book, b1)
+
+        row.book = b2
+        self.assertEqual(row.book_id, str(b2.pk))
+        self.assertEqual(row.book, b2)
+
+
 class UtilsTestCase(unittest.TestCase):
 
     def test_uniqify(self):
@@ -769,6 +1349,76 @@ class UtilsTestCase(unittest.TestCase):
             [ { 'a': 1, 'b': 3 }, { 'a': 2, 'b': 2 } ]
         )
 
+    def test_id_factory(self):
+        for num_bytes in (0, 1, 15, 16, 32):
+            for _ in range(50):
+                data = os.urandom(num_bytes)
+                self.assertEqual(zbase62_encode(data), zbase62.b2a(data))
+
+        ids = [generate_id('test') for _ in range(1000)]
+        self.assertEqual(len(set(ids)), 1000)
+        for id in ids:
+            self.assertTrue(id.startswith('test_'))
+            uuid_obj = id_to_uuid(id)
+            self.assertEqual(uuid_obj.version, 4)
+            self.assertEqual(uuid_to_id(uuid_obj, 'test'), id)
+
+        factory = IDFactory(num_bytes=32, pool_size=10)
+        ids = [factory.get(u'doc') for _ in range(25)]
+        self.assertEqual(len(set(ids)), 25)
+        self.assertTrue(all(isinstance(id, unicode) and id.startswith(u'doc_') and
+                            len(zbase62.a2b(str(id[4:]))) == 32 for id in ids))
+
+    def test_id_codec(self):
+        for length in (0, 1, 21, 22, 43):
+            for _ in range(50):
+                chars = ''.join(random.choice(string.ascii_letters + string.digits)
+                                for _ in range(length))
+                self.assertEqual(zbase62_decode(chars), zbase62.a2b(chars))
+
+        ids = [generate_id('test') for _ in range(100)]
+        uuids = ids_to_uuids(ids)
+        self.assertEqual(uuids, [id_to_uuid(id) for id in ids])
+        self.assertEqual(uuids_to_ids(uuids, 'test'), ids)
+
+        self.assertRaises(ValueError, ids_to_uuids, ['test_invalid'])
+        self.assertEqual(ids_to_uuids(['test_invalid', uuids[0]], default=None),
+                         [None, uuids[0]])
+
+        class Doc(Document):
+            ref = IDField(prefix='test')
+
+        self.assertEqual(Doc.objects.filter(ref__in=ids[:2] + ['invalid'])._query,
+                         {'ref': {'$in': uuids[:2] + [None]}})
+
+    def test_time_ordered_ids(self):
+        start = datetime.datetime.utcnow().replace(microsecond=0)
+
+        ids = []
+        for _ in range(3):
+            ids.append(generate_time_ordered_id('test'))
+            time.sleep(0.002)  # make sure the timestamps differ
+        self.assertEqual(sorted(ids), ids)
+        self.assertEqual(sorted(ids_to_uuids(ids)), ids_to_uuids(ids))
+        self.assertEqual(id_to_uuid(ids[0]).version, 7)
+        self.assertEqual(len(ids[0]), len(generate_id('test')))
+
+        created = id_to_datetime(ids[0])
+        self.assertTrue(start <= created <= datetime.datetime.utcnow())
+        self.assertEqual(uuid_to_datetime(id_to_uuid(ids[0])), created)
+        self.assertTrue(datetime_to_id(created, 'test') <= ids[0] <
+                        datetime_to_id(created + datetime.timedelta(seconds=1), 'test'))
+
+        class Doc(RandomPKDocument):
+            time_ordered_pk = True
+            ref = IDField(prefix='test', autogenerate=True, time_ordered=True)
+
+        doc = Doc()
+        self.assertEqual(id_to_uuid(doc.ref).version, 7)
+        pk = Doc.generate_pk()
+        self.assertEqual(len(pk.split('_')[1]), 43)  # 32 bytes
+        self.assertTrue(start <= id_to_datetime(pk) <= datetime.datetime.utcnow())
+
 class DeclEnumTestCase(unittest.TestCase):
     def test_enum(self):
         class TestEnum(DeclEnum):
@@ -783,6 +1433,440 @@ class DeclEnumTestCase(unittest.TestCase):
         self.assertEqual(db_type.enum.values(), ['alpha_value', 'beta_value'])
 
 
+class ForbiddenQueriesTestCase(unittest.TestCase):
+    def test_forbidden_queries(self):
+        class QuerySet(ForbiddenQueriesQuerySet):
+            forbidden_queries = [
+                {'query_shape': {'name': 1}},
+                {'query_shape': {'i': {'$gte': 1}}, 'max_allowed_limit': 5},
+            ]
+
+        class D(db.Document):
+            name = StringField()
+            i = IntField()
+
+            meta = {
+                'queryset_class': QuerySet,
+            }
+
+        D.drop_collection()
+        for i in range(10):
+            D.objects.create(name=str(i), i=i)
+
+        self.assertRaises(ForbiddenQueryException, list, D.objects.filter(name='1'))
+        self.assertRaises(ForbiddenQueryException, lambda: D.objects.filter(name='1')[:2])
+        self.assertEqual(len(D.objects.filter(name='1').mark_as_safe()), 1)
+
+        self.assertEqual(len(D.objects.filter(i__gte=1).limit(5)), 5)
+        self.assertEqual(len(D.objects.filter(i__gte=1)[:5]), 5)
+        self.assertRaises(ForbiddenQueryException, list, D.objects.filter(i__gte=1))
+        self.assertRaises(ForbiddenQueryException, lambda: D.objects.filter(i__gte=1)[:10])
+
+        # the query is only checked on the first next() of a cursor
+        qs = D.objects.filter(i__gte=1).mark_as_safe()
+        check = qs._check_for_forbidden_queries
+        calls = []
+        qs._check_for_forbidden_queries = lambda *args: calls.append(args) or check(*args)
+        self.assertEqual(len(list(qs)), 9)
+        self.assertEqual(len(calls), 1)
+
+        # replacing the rules takes effect
+        QuerySet.forbidden_queries = QuerySet.forbidden_queries + [{'query_shape': {'i': 1}}]
+        self.assertRaises(ForbiddenQueryException, list, D.objects.filter(i=1))
+        QuerySet.forbidden_queries = []
+        self.assertEqual(len(D.objects.filter(name='1')), 1)
+
+
+class QueryTelemetryTestCase(unittest.TestCase):
+    def test_query_stats(self):
+        class QuerySet(TelemetryQuerySet):
+            query_stats = QueryStats(max_shapes=2)
+
+        class D(db.Document):
+            i = IntField()
+
+            meta = {
+                'queryset_class': QuerySet,
+            }
+
+        D.drop_collection()
+        for i in range(10):
+            D.objects.create(i=i)
+
+        stats = QuerySet.query_stats
+        stats.reset()
+
+        for i in range(3):
+            self.assertEqual(len(list(D.objects.filter(i__gte=i))), 10 - i)
+        self.assertEqual(D.objects.filter(i=5)[0].i, 5)
+
+        report = stats.report()
+        self.assertEqual(len(report), 2)
+        self.assertEqual(report[0]['query_shape'], {'i': {'$gte': 1}})
+        self.assertEqual(report[0]['count'], 3)
+        self.assertEqual(report[0]['docs_returned'], 27)
+        self.assertTrue(0 < report[0]['p95_time'] <= report[0]['total_time'])
+        self.assertEqual(report[1]['query_shape'], {'i': 1})
+        self.assertEqual((report[1]['count'], report[1]['limit']), (1, 1))
+
+        # only the costliest shapes are kept
+        list(D.objects.filter(i__lt=5).limit(2))
+        self.assertEqual(len(stats.dump()), 2)
+
+        dumps = []
+        stats.set_dump_hook(dumps.append, interval=0)
+        list(D.objects.filter(i__gte=9))
+        self.assertEqual(len(dumps), 2)  # one next() with a document, one without
+        self.assertEqual(stats.dump(), [])
+
+
+class IndexAdvisorTestCase(unittest.TestCase):
+    def test_index_advisor(self):
+        class QuerySet(TelemetryQuerySet):
+            query_stats = QueryStats()
+
+        class IndexedDoc(db.Document):
+            account = StringField()
+            i = IntField(db_field='n')
+            s = StringField()
+
+            meta = {
+                'queryset_class': QuerySet,
+                'indexes': ['account'],
+            }
+
+        IndexedDoc.drop_collection()
+        IndexedDoc.ensure_indexes()
+        for i in range(20):
+            IndexedDoc.objects.create(account='a%d' % (i % 2), i=i, s='s')
+
+        advisor = IndexAdvisor()
+
+        result = advisor.analyze(IndexedDoc, {'account': 'a0'})
+        self.assertEqual(result['problems'], [])
+        self.assertEqual(result['suggested_index'], None)
+
+        result = advisor.analyze(IndexedDoc, {'s': 's'})
+        self.assertTrue('collscan' in result['problems'])
+        self.assertEqual(result['suggested_index'], {'fields': ['s']})
+
+        result = advisor.analyze(IndexedDoc, {'account': 'a0', 'n': {'$gte': 5}}, [('s', -1)])
+        self.assertEqual(result['problems'], ['in_memory_sort'])
+        self.assertEqual(result['suggested_index'], {'fields': ['account', '-s', 'i']})
+
+        # shapes recorded during the "test run"
+        QuerySet.query_stats.reset()
+        list(IndexedDoc.objects.filter(account='a1'))
+        list(IndexedDoc.objects.filter(i__lt=3))
+        results = advisor.analyze_query_stats(QuerySet.query_stats)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['query'], {'n': {'$lt': 1}})
+        self.assertEqual(results[0]['suggested_index'], {'fields': ['i']})
+
+        # shapes that aren't valid queries are estimated
+        QuerySet.query_stats.reset()
+        list(IndexedDoc.objects.filter(__raw__={'$or': [{'account': 'a0'}, {'account': 'a1'}]}))
+        list(IndexedDoc.objects.filter(__raw__={'s': {'$regex': '^s'}}))
+        results = advisor.analyze_query_stats(QuerySet.query_stats)
+        self.assertEqual([entry['query'] for entry in results], [{'s': {'$regex': 1}}])
+        self.assertTrue(results[0]['estimated'])
+
+        # $and and $or clauses
+        result = advisor.analyze(IndexedDoc, {'$and': [{'account': 'a0'}, {'n': {'$gt': 1}}]})
+        self.assertEqual(result['problems'], [])
+        result = advisor.analyze(IndexedDoc, {'$or': [{'s': 's', 'n': 1}, {'s': 't'}]})
+        self.assertTrue('collscan' in result['problems'])
+        self.assertEqual(result['suggested_index'], {'fields': ['s']})
+
+    def test_inherited_documents(self):
+        class QuerySet(TelemetryQuerySet):
+            query_stats = QueryStats()
+
+        class Animal(db.Document):
+            name = StringField()
+
+            meta = {
+                'queryset_class': QuerySet,
+                'allow_inheritance': True,
+                'index_cls': False,
+            }
+
+        class Dog(Animal):
+            pass
+
+        Animal.drop_collection()
+        Dog.objects.create(name='Rex')
+        list(Dog.objects.filter(name='Rex'))
+
+        # stats are kept by the registered class name
+        [entry] = QuerySet.query_stats.dump()
+        self.assertEqual(entry['document'], 'Animal.Dog')
+
+        results = IndexAdvisor().analyze_query_stats(QuerySet.query_stats)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['document'], 'Animal.Dog')
+        self.assertEqual(results[0]['suggested_index'], {'fields': ['name']})
+
+    def test_strict_mode(self):
+        class QuerySet(StrictIndexQuerySet):
+            strict_min_collection_size = 5
+
+        class StrictDoc(db.Document):
+            account = StringField()
+            i = IntField()
+
+            meta = {
+                'queryset_class': QuerySet,
+                'indexes': ['account'],
+            }
+
+        StrictDoc.drop_collection()
+        StrictDoc.ensure_indexes()
+        for i in range(4):
+            StrictDoc.objects.create(account='a', i=i)
+
+        # small collection
+        self.assertEqual(len(list(StrictDoc.objects.filter(i=1))), 1)
+
+        StrictDoc.objects.create(account='b', i=4)
+        self.assertEqual(len(list(StrictDoc.objects.filter(account='b'))), 1)
+        self.assertRaises(CollectionScanException, lambda: list(StrictDoc.objects.filter(i=1)))
+        self.assertRaises(CollectionScanException, StrictDoc.objects.filter(i=1).first)
+        self.assertRaises(CollectionScanException, lambda: StrictDoc.objects.filter(i=1)[:2])
+        self.assertRaises(CollectionScanException, StrictDoc.objects.filter(i=1).count)
+        self.assertEqual(StrictDoc.objects.filter(account='b').first().i, 4)
+        self.assertEqual(len(list(StrictDoc.objects.filter(account='a')[:2])), 2)
+        self.assertEqual(StrictDoc.objects.filter(account='a').count(), 4)
+        self.assertEqual(StrictDoc.objects.count(), 5)
+
+
+class InProcessQueryCounterTestCase(unittest.TestCase):
+    def test_query_counter(self):
+        class CountedDoc(db.Document):
+            i = IntField()
+
+        CountedDoc.drop_collection()
+        CountedDoc.objects.create(i=0)
+
+        with inprocess_query_counter() as q:
+            self.assertEqual(q, 0)
+            CountedDoc.objects.create(i=1)
+            self.assertEqual(q, 1)
+
+            with inprocess_query_counter() as inner_q:
+                self.assertEqual(len(list(CountedDoc.objects.filter(i__gte=0))), 2)
+                self.assertEqual(CountedDoc.objects.filter(i=1).count(), 1)
+                self.assertEqual(CountedDoc.objects.get(i=1).i, 1)
+            self.assertEqual(inner_q, 3)
+            self.assertEqual(q, 4)
+
+            ns = CountedDoc._get_collection().full_name
+            self.assertEqual(
+                [(query['ns'], query['op'], query['query'], query['docs']) for query in inner_q.queries],
+                [(ns, 'query', {'i': {'$gte': 1}}, 2),
+                 (ns, 'count', {'i': 1}, None),
+                 (ns, 'query', {'i': 1}, 1)]
+            )
+            self.assertTrue(all(query['duration'] >= 0 for query in q.queries))
+
+            # other threads' queries aren't counted
+            thread = threading.Thread(target=lambda: list(CountedDoc.objects.all()))
+            thread.start()
+            thread.join()
+            self.assertEqual(q, 4)
+
+            class IgnoringCounter(inprocess_query_counter):
+                def get_ignored_collections(self):
+                    return [ns]
+
+            with IgnoringCounter() as ignoring_q:
+                CountedDoc.objects.first()
+            self.assertEqual(ignoring_q, 0)
+            self.assertEqual(q, 5)
+
+        # not counted anymore
+        CountedDoc.objects.first()
+        self.assertEqual(q, 5)
+
+    def test_bulk_writes(self):
+        class CountedDoc(DocumentBase):
+            i = IntField()
+
+        CountedDoc.drop_collection()
+        ns = CountedDoc._get_collection().full_name
+
+        with inprocess_query_counter() as q:
+            inserted, errors = CountedDoc.bulk_insert([CountedDoc(i=i) for i in range(5)],
+                                                      batch_size=2)
+            self.assertEqual(q, 3)
+            CountedDoc.bulk_update([(doc, {'inc__i': 1}) for doc in inserted])
+            self.assertEqual(q, 4)
+
+        self.assertEqual([(query['ns'], query['op']) for query in q.queries],
+                         [(ns, 'insert')] * 3 + [(ns, 'update')])
+        self.assertEqual(q.queries[-1]['query'], {'_id': 1})
+
+
+class NPlusOneTestCase(unittest.TestCase):
+    def setUp(self):
+        class Target(db.Document):
+            txt = StringField()
+
+        class Referrer(db.Document):
+            ref = ReferenceField(Target)
+
+        Target.drop_collection()
+        Referrer.drop_collection()
+        for i in range(3):
+            Referrer.objects.create(ref=Target.objects.create(txt=str(i)))
+
+        self.Referrer = Referrer
+
+    def test_detector(self):
+        with NPlusOneDetector(threshold=2, raise_errors=True) as detector:
+            objs = list(self.Referrer.objects.all())
+            fetch_related(objs, {'ref': True})
+            self.assertEqual([obj.ref.txt for obj in objs], ['0', '1', '2'])
+        self.assertEqual(detector.get_report(), [])
+
+        with NPlusOneDetector(threshold=2) as detector:
+            for obj in self.Referrer.objects.all():
+                obj.ref.txt
+        report = detector.get_report()
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]['count'], 3)
+        self.assertEqual((report[0]['document'], report[0]['field']), ('Referrer', 'ref'))
+        self.assertEqual(report[0]['field_dict'], {'ref': True})
+        self.assertTrue(report[0]['call_site'].startswith(__file__.rstrip('c')))
+
+        with NPlusOneDetector(threshold=2, raise_errors=True):
+            self.assertRaises(NPlusOneException,
+                              lambda: [obj.ref for obj in self.Referrer.objects.all()])
+
+    def test_soft_delete_target(self):
+        class Member(DocumentBase, RandomPKDocument, SoftDeleteDocument):
+            name = StringField()
+
+        Model = declarative_base(cls=Base)
+
+        class Row(Model):
+            __tablename__ = 'nplusone_row'
+            member_id = sa.Column(sa.String)
+            member = MongoReference('member_id', Member)
+
+        Member.drop_collection()
+        rows = [Row(member=Member.objects.create(name=str(i))) for i in range(3)]
+
+        # the fetches by pk are filtered by is_deleted
+        with NPlusOneDetector(threshold=2) as detector:
+            self.assertEqual([row.member.name for row in rows], ['0', '1', '2'])
+        report = detector.get_report()
+        self.assertEqual(len(report), 1)
+        self.assertEqual((report[0]['document'], report[0]['field']), ('Row', 'member'))
+        self.assertEqual(report[0]['suggestion'], "fetch_mongo_references(objs, ['member'])")
+
+    def test_request_detection(self):
+        nplusone_app = Flask('nplusone')
+        nplusone_app.config.update(TESTING=True, NPLUSONE_DETECTION=True,
+                                   NPLUSONE_THRESHOLD=2, NPLUSONE_RAISE=True)
+        init_nplusone_detection(nplusone_app)
+
+        @nplusone_app.route('/')
+        def index():
+            return ','.join(obj.ref.txt for obj in self.Referrer.objects.all())
+
+        client = nplusone_app.test_client()
+        self.assertRaises(NPlusOneException, client.get, '/')
+
+        nplusone_app.config['NPLUSONE_THRESHOLD'] = 3
+        self.assertEqual(client.get('/').data, '0,1,2')
+
+
+class ReferenceLoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        Book.drop_collection()
+        self.books = [Book.objects.create() for i in range(3)]
+
+    def test_loader(self):
+        loader = ReferenceLoader()
+        with inprocess_query_counter() as q:
+            refs = loader.load_many(Book, [book.pk for book in self.books])
+            missing_id = ObjectId()
+            missing_ref = loader.load(Book, missing_id)
+            self.assertEqual(refs[0].pk, self.books[0].pk)
+            self.assertTrue(isinstance(refs[0], Book))
+            self.assertEqual(q, 0)
+
+            self.assertEqual(refs, self.books)
+            self.assertEqual(q, 1)
+            self.assertRaises(DoesNotExist, lambda: missing_ref.id)
+            self.assertEqual(q, 1)  # known to be missing
+
+            # fetched documents are returned right away
+            self.assertTrue(type(loader.load(Book, self.books[0].pk)) is Book)
+
+        self.assertEqual(loader.cache_map[Book][missing_id], None)
+        self.assertEqual(set(loader.cache_map[Book]) - set([missing_id]),
+                         set(book.pk for book in self.books))
+
+    def test_mongo_reference(self):
+        Model = declarative_base(cls=Base)
+
+        class Row(Model):
+            __tablename__ = 'row'
+            book_id = sa.Column(sa.String)
+            book = MongoReference('book_id', Book)
+
+        rows = [Row(book=book) for book in self.books]
+
+        loader_app = Flask('loader')
+        loader_app.config['REFERENCE_LOADER_ENABLED'] = True
+        with loader_app.app_context(), inprocess_query_counter() as q:
+            books = [row.book for row in rows]
+            self.assertEqual(q, 0)
+            self.assertEqual(books, self.books)
+            self.assertEqual(q, 1)
+            self.assertTrue(get_reference_loader().cache_map[Book])
+
+    def test_fetch_related(self):
+        class Shelf(db.Document):
+            book = ReferenceField(Book)
+
+        Shelf.drop_collection()
+        shelves = [Shelf.objects.create(book=book) for book in self.books]
+
+        loader = ReferenceLoader()
+        proxies = loader.load_many(Shelf, [shelf.pk for shelf in shelves])
+        proxies.append(loader.load(Shelf, ObjectId()))
+        with inprocess_query_counter() as q:
+            fetch_related(proxies, {'book': True})
+            self.assertEqual(q, 2)  # one query for the shelves, one for the books
+            self.assertEqual([proxy.book for proxy in proxies[:3]], self.books)
+            self.assertEqual(q, 2)
+
+    def test_invalidation(self):
+        class Member(DocumentBase, RandomPKDocument, SoftDeleteDocument):
+            name = StringField()
+
+        Member.drop_collection()
+        member = Member.objects.create(name='Steve')
+
+        loader_app = Flask('loader')
+        loader_app.config['REFERENCE_LOADER_ENABLED'] = True
+        with loader_app.app_context():
+            loader = get_reference_loader()
+            self.assertEqual(loader.load(Member, member.pk).name, 'Steve')
+
+            member.update(set__name='Tony')
+            self.assertEqual(loader.load(Member, member.pk).name, 'Tony')
+
+            member.delete()
+            self.assertRaises(DoesNotExist, lambda: loader.load(Member, member.pk).name)
+
+            Member.all_objects.filter(pk=member.pk).restore()
+            self.assertEqual(loader.load(Member, member.pk).name, 'Tony')
+
+
 class IterNoCacheTestCase(unittest.TestCase):
     def test_no_cache(self):
         import weakref
@@ -817,6 +1901,106 @@ class IterNoCacheTestCase(unittest.TestCase):
         self.assertEqual({d.i for d in iter_no_cache(D.objects.all().batch_size(5))}, set(range(10)))
         self.assertEqual({d.i for d in iter_no_cache(D.objects.order_by('i').limit(1))}, set(range(1)))
 
+    def test_adaptive_batch_size(self):
+        sizer = AdaptiveBatchSizer(batch_size=100, target_bytes=10000,
+                                   target_latency=1.0, min_batch_size=10,
+                                   max_batch_size=1000)
+
+        # grows by at most 2x
+        self.assertEqual(sizer.record_batch(100, 0.01, 10), 200)
+        # limited by the latency target
+        self.assertEqual(sizer.record_batch(200, 2.0, 10), 100)
+        # limited by the size target (average doc size is now 55 bytes)
+        self.assertEqual(sizer.record_batch(100, 0.01, 100), 181)
+        # never below the minimum
+        self.assertEqual(sizer.record_batch(181, 100.0, 10000), 10)
+
+        class D(db.Document):
+            i = IntField()
+
+        D.drop_collection()
+
+        for i in range(10):
+            D(i=i).save()
+
+        stats = []
+        sizer = AdaptiveBatchSizer(batch_size=3, min_batch_size=2,
+                                   stats_hook=stats.append)
+        qs = iter_no_cache(D.objects.all(), batch_sizer=sizer)
+        self.assertEqual({d.i for d in qs}, set(range(10)))
+        self.assertTrue(stats)
+        self.assertEqual(stats[0]['batch_size'], 3)
+        self.assertEqual(stats[0]['docs'], 3)
+
+        # raw documents are measured, so it works with any queryset
+        sizer = AdaptiveBatchSizer(batch_size=3, min_batch_size=2)
+        qs = iter_no_cache(D.objects.scalar('i'), batch_sizer=sizer)
+        self.assertEqual(set(qs), set(range(10)))
+        self.assertTrue(sizer.doc_bytes)
+
+    def test_partitioned(self):
+        class D(db.Document):
+            i = IntField()
+
+        D.drop_collection()
+
+        for i in range(10):
+            D(i=i).save()
+
+        # partitions are disjoint and cover the whole queryset
+        self.assertEqual(
+            [sorted(d.i for d in qs) for qs in partition_queryset(D.objects.all(), 3, field='i')],
+            [[0, 1, 2], [3, 4, 5], [6, 7, 8, 9]]
+        )
+        self.assertEqual(
+            sorted(d.i for qs in partition_queryset(D.objects.filter(i__gte=2), 4) for d in qs),
+            range(2, 10)
+        )
+
+        self.assertEqual(
+            sorted(d.i for d in iter_partitioned(D.objects.all(), 4, queue_size=2)),
+            range(10)
+        )
+        self.assertEqual(
+            sum(map_partitions(D.objects.all(), lambda docs: sum(d.i for d in docs), 3, field='i')),
+            sum(range(10))
+        )
+
+    def test_checkpointed(self):
+        class D(db.Document):
+            i = IntField()
+
+        D.drop_collection()
+
+        for i in range(10):
+            D(i=i).save()
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(path)
+        store = FileCheckpointStore(path)
+
+        # stop in the middle of the second batch
+        seen = []
+        for d in iter_checkpointed(D.objects.all(), 'test', store, batch_size=3, field='i'):
+            seen.append(d.i)
+            if len(seen) == 5:
+                break
+        self.assertEqual(store.get('test'), 2)
+
+        # resume after the last processed batch
+        self.assertEqual(
+            [d.i for d in iter_checkpointed(D.objects.all(), 'test', store, batch_size=3, field='i')],
+            range(3, 10)
+        )
+        self.assertEqual(store.get('test'), None)
+
+        self.assertEqual(
+            [d.i for d in iter_checkpointed(D.objects.all(), resume_from=6, batch_size=2, field='i')],
+            range(7, 10)
+        )
+        os.remove(path)
+
 
 if __name__ == '__main__':
     unittest.main()